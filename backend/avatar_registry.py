@@ -0,0 +1,46 @@
+"""
+Registry of prepared still avatars.
+
+Face detection, cropping and resizing of a still avatar only depend on the
+image itself, so they are done once when the avatar is registered and the
+result is kept in memory, keyed by a hash of the image bytes.
+"""
+import hashlib
+import threading
+
+import cv2
+import numpy as np
+
+
+class AvatarRegistry:
+    def __init__(self, engine):
+        self.engine = engine
+        self.current = None
+        self._avatars = {}
+        self._lock = threading.Lock()
+
+    def register_bytes(self, content, make_current=True):
+        """Prepare the avatar image in `content` unless it is already known"""
+        key = hashlib.sha256(content).hexdigest()
+
+        with self._lock:
+            avatar = self._avatars.get(key)
+            if avatar is None:
+                image = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if image is None:
+                    raise ValueError("Avatar is not a readable image")
+
+                print(f"Preparing avatar {key[:12]}")
+                avatar = self.engine.prepare_avatar(image, key=key)
+                self._avatars[key] = avatar
+
+            if make_current:
+                self.current = avatar
+        return avatar
+
+    def register_file(self, path, make_current=True):
+        with open(path, "rb") as f:
+            return self.register_bytes(f.read(), make_current=make_current)
+
+    def get(self, key):
+        return self._avatars.get(key)
@@ -0,0 +1,155 @@
+"""
+Token-budgeted conversation history.
+
+Only the most recent turns that fit in the token budget are sent to the
+model. The budget covers the whole prompt: the system prompt, any system
+messages the caller puts in front of the window (`prefix_tokens`) and the
+summary are subtracted before turns are counted. Turns that fall out of
+the window are folded into a rolling summary by a background thread, so
+long sessions keep their context without the prompt growing with every
+turn.
+"""
+import threading
+
+import tiktoken
+
+SUMMARY_PROMPT = """
+You maintain a running summary of a negotiation coaching conversation between a user and Kirk.
+Update the summary with the new messages below. Keep the facts, goals, numbers and advice that
+matter for the rest of the conversation. Use at most 150 words and no preamble.
+
+Current summary:
+{summary}
+
+New messages:
+{messages}
+"""
+
+
+def summarize_with(client, model="gpt-3.5-turbo"):
+    """Summarizer for ConversationHistory that uses an OpenAI client"""
+    def summarize(summary, messages):
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        response = client.chat.completions.create(
+            model=model,
+            messages=[{
+                "role": "user",
+                "content": SUMMARY_PROMPT.format(summary=summary or "(none)", messages=transcript),
+            }],
+            temperature=0,
+        )
+        return response.choices[0].message.content.strip()
+
+    return summarize
+
+
+class ConversationHistory:
+    def __init__(self, system_prompt=None, summarize=None, token_budget=3000,
+                 min_recent_turns=2, model="gpt-4", prefix_tokens=0):
+        self.system_prompt = system_prompt
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.min_recent_turns = min_recent_turns
+        self.prefix_tokens = prefix_tokens
+        self.messages = []
+        self.summary = ""
+        self._overflow = []
+        self._summarizing = False
+        self._lock = threading.Lock()
+
+        try:
+            self._encoding = tiktoken.encoding_for_model(model)
+        except Exception as e:
+            # e.g. the encoding cannot be downloaded; fall back to an estimate
+            print(f"Error loading tiktoken encoding: {str(e)}")
+            self._encoding = None
+
+    def count_tokens(self, text):
+        if self._encoding is None:
+            return len(text) // 4 + 1
+        return len(self._encoding.encode(text))
+
+    def _message_tokens(self, message):
+        # Role and separators cost a few tokens on top of the content
+        return self.count_tokens(message["content"]) + 4
+
+    def _summary_message(self):
+        return {"role": "system", "content": f"Summary of the earlier conversation:\n{self.summary}"}
+
+    def window(self):
+        """Messages to send with the next user message"""
+        with self._lock:
+            messages = []
+            if self.system_prompt:
+                messages.append({"role": "system", "content": self.system_prompt})
+            if self.summary:
+                messages.append(self._summary_message())
+            return messages + list(self.messages)
+
+    def add_turn(self, user_text, assistant_text):
+        with self._lock:
+            self.messages.append({"role": "user", "content": user_text})
+            self.messages.append({"role": "assistant", "content": assistant_text})
+            self._trim()
+            start = self._overflow and self.summarize is not None and not self._summarizing
+            if start:
+                self._summarizing = True
+        if start:
+            threading.Thread(target=self._summarize_overflow, name="history-summary", daemon=True).start()
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "messages": list(self.messages),
+                # Turns waiting to be summarized are kept so nothing is lost
+                "overflow": list(self._overflow),
+                "summary": self.summary,
+            }
+
+    def restore(self, state):
+        with self._lock:
+            self.messages = list(state.get("messages", []))
+            self._overflow = list(state.get("overflow", []))
+            self.summary = state.get("summary", "")
+
+    def clear(self):
+        with self._lock:
+            self.messages = []
+            self.summary = ""
+            self._overflow = []
+
+    def _trim(self):
+        """Move the oldest turns out of the window until it fits the budget"""
+        budget = self.token_budget - self.prefix_tokens
+        if self.system_prompt:
+            budget -= self._message_tokens({"role": "system", "content": self.system_prompt})
+        if self.summary:
+            budget -= self._message_tokens(self._summary_message())
+        used = sum(self._message_tokens(m) for m in self.messages)
+
+        while used > budget and len(self.messages) > 2 * self.min_recent_turns:
+            turn, self.messages = self.messages[:2], self.messages[2:]
+            used -= sum(self._message_tokens(m) for m in turn)
+            self._overflow.extend(turn)
+
+    def _summarize_overflow(self):
+        while True:
+            with self._lock:
+                batch, self._overflow = self._overflow, []
+                summary = self.summary
+                if not batch:
+                    self._summarizing = False
+                    return
+
+            try:
+                summary = self.summarize(summary, batch)
+            except Exception as e:
+                print(f"Error summarizing history: {str(e)}")
+                with self._lock:
+                    # Retry with the next turn that overflows
+                    self._overflow = batch + self._overflow
+                    self._summarizing = False
+                return
+
+            with self._lock:
+                self.summary = summary
@@ -0,0 +1,106 @@
+"""
+Background jobs for long-running chat turns.
+
+A job records which stage of the turn it is in (llm, tts, face, render, mux)
+and how far that stage has got, plus the partial result (reply text, then
+audio URL, then video URL) as it becomes available. Stages are updated from
+the event loop and from render worker threads alike.
+"""
+import asyncio
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+STAGES = ("queued", "llm", "tts", "face", "render", "mux", "done", "failed")
+FINAL_STAGES = ("done", "failed")
+
+
+class Job:
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.stage = "queued"
+        self.progress = 0
+        self.result = {}
+        self.error = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.version = 0
+        self._lock = threading.Lock()
+
+    def update(self, stage=None, progress=None, **result):
+        """Move to `stage` / set the stage's progress (0-1) and merge result fields"""
+        with self._lock:
+            if stage is not None and stage != self.stage:
+                self.stage = stage
+                self.progress = 0
+            if progress is not None:
+                self.progress = int(round(progress * 100))
+            self.result.update(result)
+            self.updated_at = time.time()
+            self.version += 1
+
+    def fail(self, error):
+        with self._lock:
+            self.stage = "failed"
+            self.error = error
+            self.updated_at = time.time()
+            self.version += 1
+
+    @property
+    def finished(self):
+        return self.stage in FINAL_STAGES
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "job_id": self.id,
+                "stage": self.stage,
+                "progress": self.progress,
+                "result": dict(self.result),
+                "error": self.error,
+            }
+
+
+class JobStore:
+    """In-memory jobs, dropping the oldest beyond `max_jobs` or after `ttl` seconds"""
+
+    def __init__(self, max_jobs=500, ttl=3600):
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self):
+        job = Job()
+        with self._lock:
+            self._evict()
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            self._evict()
+            return self._jobs.get(job_id)
+
+    def _evict(self):
+        cutoff = time.time() - self.ttl
+        while self._jobs:
+            oldest = next(iter(self._jobs.values()))
+            if len(self._jobs) < self.max_jobs and oldest.updated_at > cutoff:
+                break
+            self._jobs.popitem(last=False)
+
+
+async def events(job, poll_interval=0.2):
+    """Server-sent events with the job state, one per change, until it finishes"""
+    seen = -1
+    while True:
+        if job.version != seen:
+            seen = job.version
+            state = job.to_dict()
+            yield f"data: {json.dumps(state)}\n\n"
+            if state["stage"] in FINAL_STAGES:
+                break
+        await asyncio.sleep(poll_interval)
@@ -1,30 +1,56 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Body
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Body, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 import os
+import asyncio
+import concurrent.futures
 import tempfile
 import sounddevice as sd
 import numpy as np
 import scipy.io.wavfile as wav
 from openai import OpenAI
 from dotenv import load_dotenv
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import uuid
-import requests
 import json
-import cv2
-import subprocess
 import time
-import shutil
+import hashlib
+import threading
 import glob
 import sys
 from pathlib import Path
+from collections import OrderedDict
 from whisper.op_kirk_agent import (
-    get_kirk_response,
-    summarize_reply,
-    select_best_rag_chunk,
+    aget_kirk_response,
+    astream_kirk_response,
+    system_message_tokens,
+    asummarize_reply,
+    aselect_best_rag_chunk,
 )
-from whisper.rag_engine import retrieve_chunks
+from whisper.rag_engine import (
+    DOCUMENTS_DIR,
+    TEXT_EXTENSIONS,
+    add_document,
+    get_embeddings,
+    get_vector_db,
+    list_documents,
+    remove_document,
+    retrieve_chunks,
+)
+from whisper.sentences import SentenceSplitter
+from whisper import intent_router
+from history import ConversationHistory, summarize_with
+from voice_to_voice.tts_cache import TTSCache
+from voice_to_voice import tts_client as elevenlabs
+from render_cache import RenderCache
+from response_cache import ResponseCache, history_fingerprint
+from session_store import SessionStore, SqliteSessionBackend, SESSION_HEADER, attach, session_id_from
+from wav2lip_engine import Wav2LipEngine
+from avatar_registry import AvatarRegistry
+import video_stream
+import jobs
+from render_pool import RenderPool, QueueFullError
 
 
 # Get the directory where this script is located
@@ -40,10 +66,6 @@ temp_dir = os.path.join(script_dir, "temp")
 for dir_path in [audio_dir, video_dir, library_dir, temp_dir]:
     os.makedirs(dir_path, exist_ok=True)
 
-# Create temporary working directory with no spaces
-temp_working_dir = "/tmp/wav2lip_temp"
-os.makedirs(temp_working_dir, exist_ok=True)
-
 # Load environment variables
 load_dotenv(env_path)
 
@@ -67,6 +89,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[SESSION_HEADER],
 )
 
 # Initialize OpenAI client
@@ -82,84 +105,152 @@ SYSTEM_PROMPT = (
     "You make short answers, only a few sentences long"
 )
 
-# Initialize conversation history
-chat_history = [{"role": "system", "content": SYSTEM_PROMPT}]
+def new_history():
+    """Conversation history of a session: recent turns within a token budget plus
+    a rolling summary of older ones"""
+    return ConversationHistory(
+        system_prompt=SYSTEM_PROMPT,
+        summarize=summarize_with(client),
+        token_budget=int(os.getenv("HISTORY_TOKEN_BUDGET", "3000")),
+        # The agent sends its persona + role system message in front of the window
+        prefix_tokens=system_message_tokens(),
+    )
+
+
+# One conversation per client session; SESSION_DB shares them between workers
+sessions = SessionStore(
+    new_history,
+    max_sessions=int(os.getenv("MAX_SESSIONS", "1000")),
+    ttl=int(os.getenv("SESSION_TTL", str(6 * 3600))),
+    backend=SqliteSessionBackend(os.getenv("SESSION_DB")) if os.getenv("SESSION_DB") else None,
+)
+
+# Resident Wav2Lip engine, prepared avatars and render workers, loaded at startup
+wav2lip_engine = None
+avatar_registry = None
+render_pool = None
+
+# Background video jobs. Jobs, turn insights and streams in progress are kept
+# in this worker's memory, so clients must be routed back to the same worker
+job_store = jobs.JobStore()
+background_tasks = set()
 
-# Track latest generated files
-latest_audio_file = None
-latest_video_file = None
+# Summary and book insight of recent turns by turn id, delivered after the
+# audio/video so they never hold up the critical path
+turn_insights = OrderedDict()
+MAX_TURN_INSIGHTS = 200
+
+# Rendered videos by audio, avatar and engine parameters, stored in the video directory
+render_cache = None
+if os.getenv("RENDER_CACHE", "1") != "0":
+    render_cache = RenderCache(video_dir, max_bytes=int(os.getenv("RENDER_CACHE_MB", "2048")) * 1024 * 1024)
+
+# Synthesized speech by text and voice, stored in the audio directory
+tts_cache = TTSCache(audio_dir, max_bytes=int(os.getenv("TTS_CACHE_MB", "500")) * 1024 * 1024)
+
+# One keep-alive ElevenLabs connection pool for all turns
+tts_client = elevenlabs.from_env()
+
+# Speech synthesized in the background while clients stream it
+speech_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.getenv("TTS_WORKERS", "4")), thread_name_prefix="tts"
+)
+
+# Complete turns reused for near-identical questions; RESPONSE_CACHE=0 disables it.
+# Kept per worker process, unlike the sessions in SESSION_DB
+response_cache = None
+if os.getenv("RESPONSE_CACHE", "1") != "0":
+    response_cache = ResponseCache(
+        embed=lambda text: get_embeddings().embed_query(text),
+        threshold=float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.95")),
+        max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "500")),
+        ttl=int(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600))),
+    )
 
 
 class SpeechRequest(BaseModel):
     text: str
+    stream: bool = False
 
 
-def run_wav2lip(audio_path, avatar_path=None):
-    """Run the Wav2Lip model to generate a lip-synced video using the simplified approach"""
-    print(f"Starting Wav2Lip with audio: {audio_path}")
-    
-    # Use the specified avatar or default
-    if not avatar_path:
-        avatar_path = os.path.join(library_dir, "avatar.jpeg")
+def get_default_avatar_path():
+    """Find the avatar image in the library directory"""
+    avatar_path = os.path.join(library_dir, "avatar.jpeg")
+    if not os.path.exists(avatar_path):
+        # Try png as fallback
+        avatar_path = os.path.join(library_dir, "avatar.png")
         if not os.path.exists(avatar_path):
-            # Try png as fallback
-            avatar_path = os.path.join(library_dir, "avatar.png")
-            if not os.path.exists(avatar_path):
-                raise FileNotFoundError(f"No avatar found at {avatar_path}")
-    
-    # Generate unique output filename
+            raise FileNotFoundError(f"No avatar found at {avatar_path}")
+    return avatar_path
+
+
+def new_video_path():
+    """Generate unique output filename"""
     timestamp = time.strftime("%Y%m%d_%H%M%S")
     unique_id = str(uuid.uuid4())[:8]
-    output_path = os.path.join(video_dir, f"result_{timestamp}_{unique_id}.mp4")
-    
-    # Optimize image resolution
-    img = cv2.imread(avatar_path)
-    height, width = img.shape[:2]
-    aspect_ratio = width / height
-    new_height = int(256 / aspect_ratio)
-    resized = cv2.resize(img, (256, new_height))
-    optimized_image = os.path.join(temp_dir, 'optimized_avatar.jpeg')
-    cv2.imwrite(optimized_image, resized)
-    
-    # Find Wav2Lip directory (case insensitive)
-    if os.path.exists(os.path.join(script_dir, 'wav2lip')):
-        wav2lip_dir = os.path.join(script_dir, 'wav2lip')
-    elif os.path.exists(os.path.join(script_dir, 'Wav2Lip')):
-        wav2lip_dir = os.path.join(script_dir, 'Wav2Lip')
-    else:
-        raise FileNotFoundError("Wav2Lip directory not found")
-    
-    # Copy files to the temporary directory
-    temp_audio = os.path.join(temp_working_dir, f"input_{unique_id}.mp3")
-    temp_image = os.path.join(temp_working_dir, f"face_{unique_id}.jpeg")
-    temp_output = os.path.join(temp_working_dir, f"output_{unique_id}.mp4")
-    
-    shutil.copy2(audio_path, temp_audio)
-    shutil.copy2(optimized_image, temp_image)
-    
-    # Set paths
-    inference_path = os.path.join(wav2lip_dir, 'inference.py')
-    checkpoint_path = os.path.join(wav2lip_dir, 'checkpoints', 'wav2lip_gan.pth')
-    
-    # Basic command with paths that don't have spaces
-    command = [
-        'python', inference_path,
-        '--checkpoint_path', checkpoint_path,
-        '--face', temp_image,
-        '--audio', temp_audio,
-        '--outfile', temp_output,
-        '--pads', '0', '5', '0', '0',
-        '--nosmooth'
-    ]
-    
+    return os.path.join(video_dir, f"result_{timestamp}_{unique_id}.mp4")
+
+
+def resolve_avatar(avatar_path=None):
+    """The specified avatar or the current prepared one"""
+    if avatar_path:
+        return avatar_registry.register_file(avatar_path, make_current=False)
+    if avatar_registry.current is not None:
+        return avatar_registry.current
+    return avatar_registry.register_file(get_default_avatar_path())
+
+
+def render_key(audio_path, avatar):
+    """Render cache key of `audio_path` spoken by `avatar`; None for video avatars"""
+    if render_cache is None or not getattr(avatar, "key", None):
+        return None
+    return render_cache.key(audio_path, avatar.key, wav2lip_engine.render_params())
+
+
+def run_wav2lip(audio_path, avatar_path=None, output_path=None, fragmented=False, progress=None):
+    """Run the resident Wav2Lip engine to generate a lip-synced video"""
+    print(f"Starting Wav2Lip with audio: {audio_path}")
+
+    if wav2lip_engine is None:
+        print("Wav2Lip engine is not loaded")
+        return None
+
+    if not output_path:
+        output_path = new_video_path()
+
     # Run Wav2Lip
     print("Running Wav2Lip...")
+    rendered = False
     try:
-        subprocess.run(command, check=True)
-        
-        # Copy the result back if it exists
-        if os.path.exists(temp_output):
-            shutil.copy2(temp_output, output_path)
+        avatar = resolve_avatar(avatar_path)
+
+        # The same audio and avatar always give the same video
+        key = render_key(audio_path, avatar)
+        cached_path = render_cache.get(key) if key else None
+        if cached_path is not None and not fragmented:
+            print(f"Using cached render: {cached_path}")
+            return os.path.basename(cached_path)
+
+        # Cached speech has a ready-decoded 16 kHz wav for the mels; the
+        # original mp3 is still what the video carries
+        wav_path = tts_cache.wav_for(audio_path)
+
+        # Render inside a per-job scratch directory so concurrent jobs never share
+        # files and only complete videos appear in the video directory. Streaming
+        # renders write in place since the client reads them while they grow.
+        with tempfile.TemporaryDirectory(prefix="job_", dir=temp_dir) as scratch_dir:
+            render_path = output_path if fragmented else os.path.join(scratch_dir, "result.mp4")
+            wav2lip_engine.generate(audio_path, avatar, render_path, fragmented=fragmented,
+                                    progress=progress, mel_audio_path=wav_path)
+            rendered = True
+            if key:
+                cached_path = render_cache.put(key, render_path, move=not fragmented)
+                if not fragmented:
+                    output_path = cached_path
+            elif render_path != output_path:
+                os.replace(render_path, output_path)
+
+        if os.path.exists(output_path):
             print(f"Success! Output saved to: {output_path}")
             return os.path.basename(output_path)
         else:
@@ -167,9 +258,94 @@ def run_wav2lip(audio_path, avatar_path=None):
             return None
     except Exception as e:
         print(f"Error running Wav2Lip: {str(e)}")
+        # A failed streaming render leaves a cut-off file behind
+        if fragmented and not rendered and os.path.exists(output_path):
+            os.remove(output_path)
+        return None
+
+
+def start_streaming_render(audio_path, progress=None):
+    """Queue a fragmented render and return the path it is written to and its future"""
+    if render_pool is None:
+        return None
+
+    # A cached video is served whole; there is nothing left to render
+    try:
+        key = render_key(audio_path, resolve_avatar())
+        cached_path = render_cache.get(key) if key else None
+    except Exception as e:
+        print(f"Error checking render cache: {str(e)}")
+        cached_path = None
+    if cached_path is not None:
+        future = concurrent.futures.Future()
+        future.set_result(os.path.basename(cached_path))
+        return cached_path, future
+
+    video_path = new_video_path()
+    try:
+        future = render_pool.submit(
+            run_wav2lip, audio_path, output_path=video_path, fragmented=True, progress=progress
+        )
+    except QueueFullError as e:
+        print(f"Error queueing Wav2Lip: {str(e)}")
+        return None
+
+    video_stream.track(video_path, future)
+    return video_path, future
+
+
+async def render_video(audio_path, progress=None):
+    """Render on the worker pool without blocking the event loop"""
+    if render_pool is None:
+        print("Wav2Lip engine is not loaded")
+        return None
+
+    try:
+        return await render_pool.run(run_wav2lip, audio_path, progress=progress)
+    except QueueFullError as e:
+        print(f"Error queueing Wav2Lip: {str(e)}")
         return None
 
 
+@app.on_event("startup")
+def load_wav2lip_engine():
+    """Load the Wav2Lip model and face detector once for the lifetime of the server"""
+    global wav2lip_engine, avatar_registry, render_pool
+    try:
+        wav2lip_engine = Wav2LipEngine(
+            pads=(0, 5, 0, 0),
+            nosmooth=True,
+            preset=os.getenv("WAV2LIP_PRESET", "veryfast"),
+            crf=int(os.getenv("WAV2LIP_CRF", "23")),
+        )
+        avatar_registry = AvatarRegistry(wav2lip_engine)
+        render_pool = RenderPool(
+            workers=int(os.getenv("WAV2LIP_WORKERS", "1")),
+            max_queue=int(os.getenv("WAV2LIP_MAX_QUEUE", "8")),
+        )
+    except Exception as e:
+        print(f"Error loading Wav2Lip engine: {str(e)}")
+        return
+
+    # Detect the face of the library avatar before the first request
+    try:
+        avatar_registry.register_file(get_default_avatar_path())
+    except Exception as e:
+        print(f"Error preparing default avatar: {str(e)}")
+
+
+@app.on_event("startup")
+def warm_book_index():
+    """Load (or build) the book index in the background so startup never waits on it"""
+    def load():
+        try:
+            get_vector_db()
+        except Exception as e:
+            print(f"Error loading book index: {str(e)}")
+
+    threading.Thread(target=load, name="book-index", daemon=True).start()
+
+
 @app.post("/transcribe")
 async def transcribe_audio(file: UploadFile = File(...)):
     try:
@@ -186,8 +362,11 @@ async def transcribe_audio(file: UploadFile = File(...)):
             # Transcribe audio using OpenAI's Whisper API
             with open(temp_file_path, "rb") as audio_file:
                 print("Sending audio to Whisper API")
-                transcript = client.audio.transcriptions.create(
-                    model="whisper-1", file=audio_file, language="en"
+                transcript = await run_in_threadpool(
+                    client.audio.transcriptions.create,
+                    model="whisper-1",
+                    file=audio_file,
+                    language="en",
                 )
                 print(f"Transcription successful: {transcript.text}")
 
@@ -208,65 +387,245 @@ async def transcribe_audio(file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/generate-speech")
-async def generate_speech(request: SpeechRequest):
+def synthesize_speech(text):
+    """Generate speech for `text` using ElevenLabs and return the audio filename"""
+    # Identical text with the same voice is only synthesized once
+    filepath = tts_cache.get_or_synthesize(
+        text,
+        tts_client.voice_id,
+        tts_client.voice_settings,
+        lambda path: tts_client.synthesize_to(text, path),
+    )
+    print(f"Audio saved to: {filepath}")
+    return os.path.basename(filepath)
+
+
+def start_speech(text):
+    """Start synthesizing `text` in the background; return the audio filename and its future
+
+    `/speech/stream/<filename>` serves the clip while ElevenLabs is still
+    sending it, and the finished file is the usual cached clip.
+    """
+    key = tts_cache.key(text, tts_client.voice_id, tts_client.voice_settings)
+    future = speech_pool.submit(synthesize_speech, text)
+    video_stream.track(tts_cache.partial_path(key), future)
+    return os.path.basename(tts_cache.mp3_path(key)), future
+
+
+async def follow_speech(audio_path):
+    """Bytes of a clip, read from its partial file while it is still being synthesized"""
+    partial_path = f"{audio_path}.part"
+    if video_stream.is_rendering(partial_path):
+        sent = False
+        async for chunk in video_stream.follow(partial_path):
+            sent = True
+            yield chunk
+        if sent:
+            return
+
+    # Finished before its partial file could be opened
+    if os.path.exists(audio_path):
+        with open(audio_path, "rb") as f:
+            yield f.read()
+
+
+async def build_insight(retrieval, kirk_response, text):
+    """Summary and book insight for the side panel; not needed for audio/video"""
+    async def book_insight():
+        rag_chunks = await retrieval
+        return await aselect_best_rag_chunk(rag_chunks, kirk_response, text)
+
+    summary, book_insight = await asyncio.gather(asummarize_reply(kirk_response), book_insight())
+    return {"summary": summary, "book_insight": book_insight}
+
+
+def remember_insight(turn_id, task):
+    """Keep the insight task of a recent turn so it can be fetched later"""
+    def log_error(t):
+        if not t.cancelled() and t.exception() is not None:
+            print(f"Error generating insight for turn {turn_id}: {str(t.exception())}")
+
+    task.add_done_callback(log_error)
+    turn_insights[turn_id] = task
+    while len(turn_insights) > MAX_TURN_INSIGHTS:
+        turn_insights.popitem(last=False)
+
+
+def insight_fields(turn_id):
+    """Summary and book insight of a turn if they are ready, else where to fetch them"""
+    task = turn_insights.get(turn_id)
+    if task is not None and task.done() and not task.cancelled() and task.exception() is None:
+        return task.result()
+    return {"insight_url": f"/turns/{turn_id}/insight"}
+
+
+def cache_key(session, text):
+    """Role and conversation fingerprint a cached reply must match; the role is
+    decided locally so a lookup never waits on GPT"""
+    role, _ = intent_router.route(text)
+    return role, history_fingerprint(session.history.window())
+
+
+async def find_cached_turn(text, key):
+    """Cached reply to a near-identical question with the same role and history
+
+    Returns (entry_id, fields) or None. Runs alongside retrieval and the
+    reply so a cache miss costs no extra round-trip.
+    """
+    if response_cache is None:
+        return None
     try:
-        print(f"Generating speech for text: {request.text}")
+        cached = await run_in_threadpool(response_cache.lookup, text, *key)
+    except Exception as e:
+        print(f"Error looking up response cache: {str(e)}")
+        return None
+    if cached is None:
+        return None
+
+    audio_filename = cached[1].get("audio_filename")
+    if not audio_filename or not os.path.exists(os.path.join(audio_dir, audio_filename)):
+        return None
+    return cached
+
+
+def replay_cached_turn(session, text, cached, retrieval):
+    """Answer this turn with a cached reply found by find_cached_turn
+
+    Returns (turn_id, kirk_response, audio_filename, cache_entry).
+    """
+    entry_id, fields = cached
+    kirk_response = fields["text"]
+    session.add_turn(text, kirk_response)
+    sessions.save(session)
+
+    turn_id = uuid.uuid4().hex
+    if "summary" in fields and "book_insight" in fields:
+        retrieval.cancel()
+        insight = asyncio.get_running_loop().create_future()
+        insight.set_result({"summary": fields["summary"], "book_insight": fields["book_insight"]})
+    else:
+        insight = asyncio.ensure_future(build_insight(retrieval, kirk_response, text))
+    remember_insight(turn_id, insight)
+    return turn_id, kirk_response, fields["audio_filename"], entry_id
+
 
-        # Get Kirk's response using GPT
-        # chat_history.append({"role": "user", "content": request.text})
-        # response = client.chat.completions.create(
-        #     model="gpt-3.5-turbo", messages=chat_history
-        # )
-        # kirk_response = response.choices[0].message.content
-        # chat_history.append({"role": "assistant", "content": kirk_response})
-        rag_chunks = retrieve_chunks(request.text, k=3)
-        kirk_response = get_kirk_response(request.text, chat_history)
-        summary = summarize_reply(kirk_response)
-        book_insight = select_best_rag_chunk(rag_chunks, kirk_response, request.text)
-        chat_history.append({"role": "user", "content": request.text})
-        chat_history.append({"role": "assistant", "content": kirk_response})
-
-        # Generate speech using ElevenLabs
-        elevenlabs_api_key = os.getenv("ELEVENLABS_API_KEY")
-        elevenlabs_voice_id = os.getenv("ELEVENLABS_VOICE_ID", "5ERbh3mpIEzi6sfFHo7H")
-
-        if not elevenlabs_api_key:
-            raise HTTPException(status_code=500, detail="ELEVENLABS_API_KEY not set")
-
-        url = (
-            f"https://api.elevenlabs.io/v1/text-to-speech/{elevenlabs_voice_id}/stream"
+async def cache_turn(key, text, kirk_response, audio_filename, turn_id):
+    """Store a finished turn; its insight is added once it has been generated"""
+    if response_cache is None:
+        return None
+    try:
+        entry_id = await run_in_threadpool(
+            response_cache.store, text, *key, text=kirk_response, audio_filename=audio_filename
         )
-        payload = {
-            "text": kirk_response,
-            "voice_settings": {
-                "stability": 0.2,
-                "similarity_boost": 0.95,
-                "style": 0.5,
-                "use_speaker_boost": True,
-            },
-        }
-        headers = {"xi-api-key": elevenlabs_api_key}
+    except Exception as e:
+        print(f"Error storing response cache entry: {str(e)}")
+        return None
 
-        response = requests.post(url, json=payload, headers=headers)
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=500, detail=f"Error generating speech: {response.text}"
-            )
+    def add_insight(t):
+        if not t.cancelled() and t.exception() is None:
+            response_cache.update(entry_id, **t.result())
+
+    turn_insights[turn_id].add_done_callback(add_insight)
+    return entry_id
 
-        # Save audio to file in audio directory
-        filename = f"{uuid.uuid4()}.mp3"
-        filepath = os.path.join(audio_dir, filename)
-        with open(filepath, "wb") as f:
-            f.write(response.content)
-        print(f"Audio saved to: {filepath}")
 
-        # return {"audio_url": f"/audio/{filename}", "text": kirk_response}
+def current_avatar_key():
+    if avatar_registry is None or avatar_registry.current is None:
+        return None
+    return avatar_registry.current.key
+
+
+def cache_video(entry_id, video_path):
+    """Remember the video rendered for a cached turn, with the avatar it shows"""
+    if response_cache is not None and entry_id is not None:
+        response_cache.update(
+            entry_id, video_filename=os.path.basename(video_path), avatar=current_avatar_key()
+        )
+
+
+async def run_chat_turn(session, text, on_reply=None, stream_speech=False):
+    """Get Kirk's reply and its speech; the side-panel insight follows separately
+
+    A near-identical earlier question is answered from the response cache.
+    Otherwise book retrieval runs alongside role classification and the reply.
+    As soon as the reply exists speech synthesis starts, while the summary and
+    the book insight are generated in the background under the returned turn
+    id, so they never delay the audio or video. `on_reply(kirk_response)` is
+    called once the reply is known. With `stream_speech` the speech is only
+    started, to be streamed from `/speech/stream/<audio_filename>`, and the
+    turn is cached once it is complete.
+
+    Returns (turn_id, kirk_response, audio_filename, cache_entry).
+    """
+    key = cache_key(session, text)
+    lookup = asyncio.ensure_future(find_cached_turn(text, key))
+    retrieval = asyncio.ensure_future(run_in_threadpool(retrieve_chunks, text, k=3))
+    reply = asyncio.ensure_future(aget_kirk_response(text, session.history.window()))
+    try:
+        cached = await lookup
+        if cached is not None:
+            reply.cancel()
+            turn = replay_cached_turn(session, text, cached, retrieval)
+            if on_reply is not None:
+                on_reply(turn[1])
+            return turn
+        kirk_response = await reply
+    except BaseException:
+        for task in (lookup, reply, retrieval):
+            task.cancel()
+        raise
+    session.add_turn(text, kirk_response)
+    sessions.save(session)
+
+    if on_reply is not None:
+        on_reply(kirk_response)
+
+    turn_id = uuid.uuid4().hex
+    remember_insight(turn_id, asyncio.ensure_future(build_insight(retrieval, kirk_response, text)))
+
+    if stream_speech:
+        audio_filename, synthesis = start_speech(kirk_response)
+
+        async def cache_when_synthesized():
+            try:
+                await asyncio.wrap_future(synthesis)
+            except Exception as e:
+                print(f"Error generating speech: {str(e)}")
+                return
+            await cache_turn(key, text, kirk_response, audio_filename, turn_id)
+
+        task = asyncio.create_task(cache_when_synthesized())
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+        return turn_id, kirk_response, audio_filename, None
+
+    audio_filename = await run_in_threadpool(synthesize_speech, kirk_response)
+    entry_id = await cache_turn(key, text, kirk_response, audio_filename, turn_id)
+    return turn_id, kirk_response, audio_filename, entry_id
+
+
+@app.post("/generate-speech")
+async def generate_speech(request: SpeechRequest, http_request: Request, response: Response):
+    try:
+        print(f"Generating speech for text: {request.text}")
+        session = sessions.get(session_id_from(http_request))
+        attach(response, session)
+
+        # Get Kirk's response using GPT with RAG, and speech using ElevenLabs
+        # With `stream` the reply returns before its speech is synthesized and
+        # the client plays the audio from the first bytes ElevenLabs sends
+        turn_id, kirk_response, filename, _ = await run_chat_turn(
+            session, request.text, stream_speech=request.stream
+        )
+        session.latest_audio_file = os.path.join(audio_dir, filename)
+        sessions.save(session)
+
+        audio_url = f"/speech/stream/{filename}" if request.stream else f"/audio/{filename}"
         return {
-            "audio_url": f"/audio/{filename}",
+            "turn_id": turn_id,
+            "audio_url": audio_url,
             "text": kirk_response,
-            "summary": summary,
-            "book_insight": book_insight,
+            **insight_fields(turn_id),
         }
 
     except Exception as e:
@@ -274,82 +633,382 @@ async def generate_speech(request: SpeechRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+async def stream_chat_turn(session, text):
+    """Server-sent events for a streamed turn
+
+    Tokens are forwarded as they arrive from GPT; every completed sentence is
+    sent to ElevenLabs right away and announced, in sentence order, with a
+    `/speech/stream` URL, so the first sentence plays from the first bytes
+    of its audio while later ones are still generated.
+    """
+    events = asyncio.Queue()
+
+    async def generate_reply(lookup, retrieval):
+        splitter = SentenceSplitter()
+        parts = []
+        sentences = 0
+
+        def speak(sentence):
+            nonlocal sentences
+            filename, _ = start_speech(sentence)
+            events.put_nowait({
+                "type": "audio",
+                "index": sentences,
+                "text": sentence,
+                "audio_url": f"/speech/stream/{filename}",
+            })
+            sentences += 1
+
+        try:
+            async for token in astream_kirk_response(text, session.history.window()):
+                # Nothing is sent before the cache lookup has missed, which it
+                # normally has long before the first token arrives
+                if await asyncio.shield(lookup) is not None:
+                    return None
+                parts.append(token)
+                await events.put({"type": "token", "text": token})
+                for sentence in splitter.feed(token):
+                    speak(sentence)
+            rest = splitter.flush()
+            if rest:
+                speak(rest)
+        except Exception:
+            retrieval.cancel()
+            raise
+
+        kirk_response = "".join(parts).strip()
+        session.add_turn(text, kirk_response)
+        sessions.save(session)
+
+        turn_id = uuid.uuid4().hex
+        remember_insight(turn_id, asyncio.ensure_future(build_insight(retrieval, kirk_response, text)))
+        return turn_id, kirk_response
+
+    async def run():
+        # The cache lookup runs alongside retrieval and the reply stream
+        lookup = asyncio.ensure_future(find_cached_turn(text, cache_key(session, text)))
+        retrieval = asyncio.ensure_future(run_in_threadpool(retrieve_chunks, text, k=3))
+        reply = asyncio.ensure_future(generate_reply(lookup, retrieval))
+        try:
+            cached = await lookup
+            if cached is not None:
+                # The whole reply and its audio are already available
+                reply.cancel()
+                turn_id, kirk_response, audio_filename, _ = replay_cached_turn(
+                    session, text, cached, retrieval
+                )
+                await events.put({"type": "token", "text": kirk_response})
+                await events.put({
+                    "type": "audio",
+                    "index": 0,
+                    "text": kirk_response,
+                    "audio_url": f"/audio/{audio_filename}",
+                })
+            else:
+                turn_id, kirk_response = await reply
+            await events.put({
+                "type": "done",
+                "turn_id": turn_id,
+                "text": kirk_response,
+                **insight_fields(turn_id),
+            })
+        except Exception as e:
+            print(f"Error streaming turn: {str(e)}")
+            await events.put({"type": "error", "detail": str(e)})
+        finally:
+            reply.cancel()
+            await events.put(None)
+
+    task = asyncio.ensure_future(run())
+    try:
+        while True:
+            event = await events.get()
+            if event is None:
+                break
+            yield f"data: {json.dumps(event)}\n\n"
+    finally:
+        # Stop generating if the client went away
+        task.cancel()
+
+
+@app.post("/chat/stream")
+async def chat_stream(request: SpeechRequest, http_request: Request):
+    """Stream Kirk's reply token by token with one audio clip per sentence"""
+    session = sessions.get(session_id_from(http_request))
+    response = StreamingResponse(
+        stream_chat_turn(session, request.text),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+    attach(response, session)
+    return response
+
+
+async def generate_video_turn(session, text, stream=False, job=None):
+    """Run the LLM, TTS and Wav2Lip stages of a video reply, reporting to `job`"""
+    print(f"Generating video for text: {text}")
+
+    # Get Kirk's response using GPT with RAG, and speech using ElevenLabs
+    def on_reply(kirk_response):
+        if job is not None:
+            job.update("tts", text=kirk_response)
+
+    if job is not None:
+        job.update("llm")
+    turn_id, kirk_response, audio_filename, cache_entry = await run_chat_turn(
+        session, text, on_reply=on_reply
+    )
+    audio_filepath = os.path.join(audio_dir, audio_filename)
+
+    reply = {
+        "turn_id": turn_id,
+        "audio_url": f"/audio/{audio_filename}",
+        "text": kirk_response,
+    }
+    if job is not None:
+        job.update("tts", 1., **reply)
+        turn_insights[turn_id].add_done_callback(
+            lambda t: job.update(**t.result()) if not t.cancelled() and t.exception() is None else None
+        )
+
+    # Store the latest audio file for future use
+    session.latest_audio_file = audio_filepath
+    sessions.save(session)
+
+    # A cached turn may already have its video, rendered with the same avatar
+    cached = response_cache.get(cache_entry) if response_cache is not None and cache_entry else None
+    if cached and cached.get("video_filename") and cached.get("avatar") == current_avatar_key():
+        video_path = os.path.join(video_dir, cached["video_filename"])
+        if os.path.exists(video_path) and not video_stream.is_rendering(video_path):
+            session.latest_video_file = video_path
+            sessions.save(session)
+            reply["video_url"] = f"/video/{cached['video_filename']}"
+            reply.update(insight_fields(turn_id))
+            return reply
+
+    # Run Wav2Lip to generate video
+    progress = job.update if job is not None else None
+    if stream:
+        # Render in the background and let the client play the
+        # fragmented mp4 while later frames are still being generated
+        render = start_streaming_render(audio_filepath, progress=progress)
+        if render is not None:
+            video_path, future = render
+            session.latest_video_file = video_path
+            sessions.save(session)
+            # run_wav2lip returns None instead of raising when the render fails
+            future.add_done_callback(
+                lambda f: cache_video(cache_entry, video_path)
+                if f.exception() is None and f.result() else None
+            )
+            reply["video_url"] = f"/video/stream/{os.path.basename(video_path)}"
+            if job is not None:
+                # The client can start playing now; the job ends with the render
+                job.update(video_url=reply["video_url"])
+                if not await asyncio.wrap_future(future):
+                    # The partial video is gone; end with the audio only
+                    session.latest_video_file = None
+                    sessions.save(session)
+                    del reply["video_url"]
+                    reply["error"] = "Video generation failed"
+                    job.update(video_url=None)
+            reply.update(insight_fields(turn_id))
+            return reply
+
+    video_filename = await render_video(audio_filepath, progress=progress)
+    if video_filename:
+        # Store the latest video file
+        session.latest_video_file = os.path.join(video_dir, video_filename)
+        sessions.save(session)
+        cache_video(cache_entry, session.latest_video_file)
+        reply["video_url"] = f"/video/{video_filename}"
+    else:
+        # Return audio-only response if video generation fails
+        reply["error"] = "Video generation failed"
+    reply.update(insight_fields(turn_id))
+    return reply
+
+
 @app.post("/generate-video")
-async def generate_video(request: SpeechRequest):
+async def generate_video(request: SpeechRequest, http_request: Request, response: Response):
     try:
-        print(f"Generating video for text: {request.text}")
-        
-        # Get Kirk's response using GPT with RAG
-        rag_chunks = retrieve_chunks(request.text, k=3)
-        kirk_response = get_kirk_response(request.text, chat_history)
-        summary = summarize_reply(kirk_response)
-        book_insight = select_best_rag_chunk(rag_chunks, kirk_response, request.text)
-        chat_history.append({"role": "user", "content": request.text})
-        chat_history.append({"role": "assistant", "content": kirk_response})
-        
-        # Generate speech using ElevenLabs
-        elevenlabs_api_key = os.getenv("ELEVENLABS_API_KEY")
-        elevenlabs_voice_id = os.getenv("ELEVENLABS_VOICE_ID", "5ERbh3mpIEzi6sfFHo7H")
-        
-        if not elevenlabs_api_key:
-            raise HTTPException(status_code=500, detail="ELEVENLABS_API_KEY not set")
-        
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{elevenlabs_voice_id}/stream"
-        payload = {
-            "text": kirk_response,
-            "voice_settings": {
-                "stability": 0.2,
-                "similarity_boost": 0.95,
-                "style": 0.5,
-                "use_speaker_boost": True,
-            },
-        }
-        headers = {"xi-api-key": elevenlabs_api_key}
-        
-        response = requests.post(url, json=payload, headers=headers)
-        if response.status_code != 200:
-            raise HTTPException(status_code=500, detail=f"Error generating speech: {response.text}")
-        
-        # Save audio to file in audio directory
-        audio_filename = f"{uuid.uuid4()}.mp3"
-        audio_filepath = os.path.join(audio_dir, audio_filename)
-        with open(audio_filepath, "wb") as f:
-            f.write(response.content)
-        print(f"Audio saved to: {audio_filepath}")
-        
-        # Store the latest audio file for future use
-        global latest_audio_file
-        latest_audio_file = audio_filepath
-        
-        # Run Wav2Lip to generate video
-        video_filename = run_wav2lip(audio_filepath)
-        
-        if video_filename:
-            # Store the latest video file
-            global latest_video_file
-            latest_video_file = os.path.join(video_dir, video_filename)
-            
-            return {
-                "audio_url": f"/audio/{audio_filename}",
-                "video_url": f"/video/{video_filename}",
-                "text": kirk_response,
-                "summary": summary,
-                "book_insight": book_insight
-            }
-        else:
-            # Return audio-only response if video generation fails
-            return {
-                "audio_url": f"/audio/{audio_filename}",
-                "text": kirk_response,
-                "summary": summary,
-                "book_insight": book_insight,
-                "error": "Video generation failed"
-            }
+        session = sessions.get(session_id_from(http_request))
+        attach(response, session)
+        return await generate_video_turn(session, request.text, stream=request.stream)
     except Exception as e:
         print(f"Error generating video: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/turns/{turn_id}/insight")
+async def get_turn_insight(turn_id: str):
+    """Summary and book insight of a turn, waiting for them if still in progress"""
+    task = turn_insights.get(turn_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail="Turn not found")
+    try:
+        return await asyncio.shield(task)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def run_video_job(job, session, request):
+    try:
+        reply = await generate_video_turn(session, request.text, stream=request.stream, job=job)
+        # Finish with the side-panel insight as well
+        insight = turn_insights.get(reply["turn_id"])
+        if insight is not None:
+            try:
+                reply.update(await asyncio.shield(insight))
+            except Exception:
+                pass
+        job.update("done", 1., **reply)
+    except Exception as e:
+        print(f"Error in video job {job.id}: {str(e)}")
+        job.fail(str(e))
+
+
+@app.post("/jobs/generate-video")
+async def submit_video_job(request: SpeechRequest, http_request: Request, response: Response):
+    """Start a video reply in the background and return its job id immediately"""
+    session = sessions.get(session_id_from(http_request))
+    attach(response, session)
+    job = job_store.create()
+    task = asyncio.create_task(run_video_job(job, session, request))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+    return {
+        "job_id": job.id,
+        "status_url": f"/jobs/{job.id}",
+        "events_url": f"/jobs/{job.id}/events",
+    }
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Current stage, stage progress and partial result of a job"""
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+@app.get("/jobs/{job_id}/events")
+async def get_job_events(job_id: str):
+    """Server-sent events pushing every job update until it is done"""
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return StreamingResponse(
+        jobs.events(job),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.post("/upload-avatar")
+async def upload_avatar(file: UploadFile = File(...)):
+    try:
+        content = await file.read()
+
+        # Detect and prepare the face once so generations can skip it. Face
+        # detection blocks, and an image without a face must not replace the
+        # default avatar, so the file is only written once it succeeded.
+        avatar = None
+        if avatar_registry is not None:
+            avatar = await run_in_threadpool(avatar_registry.register_bytes, content)
+
+        # Save avatar to library directory
+        with open(os.path.join(library_dir, "avatar.jpeg"), "wb") as f:
+            f.write(content)
+
+        if avatar is not None:
+            return {"message": "Avatar uploaded successfully", "avatar_id": avatar.key}
+        return {"message": "Avatar uploaded successfully"}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/library")
+async def get_library():
+    """Documents Kirk's answers can cite"""
+    try:
+        return {"documents": await run_in_threadpool(list_documents)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/library/documents")
+async def upload_document(file: UploadFile = File(...), title: str = Form(None)):
+    """Add a PDF or transcript to the library; only the new document is embedded"""
+    extension = os.path.splitext(file.filename or "")[1].lower()
+    if extension != ".pdf" and extension not in TEXT_EXTENSIONS:
+        raise HTTPException(status_code=400, detail="Only PDF and text documents are supported")
+
+    try:
+        content = await file.read()
+        os.makedirs(DOCUMENTS_DIR, exist_ok=True)
+        # Named by content so uploading the same document twice keeps one copy
+        path = os.path.join(DOCUMENTS_DIR, hashlib.sha256(content).hexdigest()[:16] + extension)
+        with open(path, "wb") as f:
+            f.write(content)
+
+        default_title = os.path.splitext(os.path.basename(file.filename))[0]
+        return await run_in_threadpool(add_document, path, title or default_title)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.delete("/library/documents/{document_id}")
+async def delete_document(document_id: str):
+    try:
+        removed = await run_in_threadpool(remove_document, document_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if not removed:
+        raise HTTPException(status_code=404, detail="Document not found")
+    return {"message": "Document removed", "document_id": document_id}
+
+
+@app.get("/stats")
+async def get_stats():
+    """Cache, render pool and session counters"""
+    return {
+        "embedding_cache": get_embeddings().stats(),
+        "render_pool": render_pool.status() if render_pool is not None else None,
+        "sessions": len(sessions),
+        "response_cache": response_cache.stats() if response_cache is not None else None,
+        "tts_cache": tts_cache.stats(),
+        "tts_client": tts_client.stats(),
+        "render_cache": render_cache.stats() if render_cache is not None else None,
+    }
+
+
+@app.get("/speech/stream/{filename}")
+async def speech_stream(filename: str):
+    """Serve speech while ElevenLabs is still synthesizing it"""
+    audio_path = os.path.join(audio_dir, filename)
+    if not video_stream.is_rendering(f"{audio_path}.part") and not os.path.exists(audio_path):
+        raise HTTPException(status_code=404, detail="Audio file not found")
+
+    return StreamingResponse(
+        follow_speech(audio_path),
+        media_type="audio/mpeg",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.get("/video/stream/{filename}")
+async def stream_video(filename: str):
+    """Serve a video progressively while it is still being rendered"""
+    video_path = os.path.join(video_dir, filename)
+    if not video_stream.is_rendering(video_path) and not os.path.exists(video_path):
+        raise HTTPException(status_code=404, detail="Video file not found")
+
+    return StreamingResponse(video_stream.follow(video_path), media_type="video/mp4")
+
+
 @app.get("/video/{filename}")
 async def get_video(filename: str):
     try:
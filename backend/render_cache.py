@@ -0,0 +1,77 @@
+"""
+Content-addressed cache of rendered lip-sync videos.
+
+With a still avatar the video is a pure function of the audio, the avatar
+and the engine parameters (checkpoint, pads, fps, smoothing, encoding), so a
+render is stored as `render_<key>.mp4` under a hash of all of them and reused
+for the same inputs. `render_index.json` records sizes and last use; the
+least recently used videos are deleted beyond the disk quota.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+from voice_to_voice.tts_cache import LRUFileIndex
+from wav2lip_engine import file_hash
+
+
+class RenderCache:
+    def __init__(self, cache_dir, max_bytes=2 * 1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index = LRUFileIndex(
+            os.path.join(cache_dir, "render_index.json"), max_bytes, lambda key: [self.path(key)]
+        )
+
+    def key(self, audio_path, avatar_key, params):
+        payload = json.dumps(
+            {"audio": file_hash(audio_path), "avatar": avatar_key, "params": params},
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"render_{key}.mp4")
+
+    def get(self, key):
+        """Path of the cached video for `key`, or None"""
+        path = self.path(key)
+        with self._lock:
+            if self._index.touch(key):
+                self.hits += 1
+                return path
+            self.misses += 1
+            return None
+
+    def put(self, key, video_path, move=True):
+        """Store a finished render; `move=False` copies it and leaves `video_path`
+        in place (e.g. while it is streamed)"""
+        path = self.path(key)
+        if move:
+            os.replace(video_path, path)
+        else:
+            # A copy rather than a hard link, so evicting it really frees the space
+            tmp_path = f"{path}.tmp-{threading.get_ident()}"
+            shutil.copyfile(video_path, tmp_path)
+            os.replace(tmp_path, path)
+
+        with self._lock:
+            self._index.add(key, os.path.getsize(path))
+        return path
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "videos": len(self._index),
+                "bytes": self._index.total_bytes(),
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,65 @@
+"""
+Bounded worker pool for video generation.
+
+N worker threads share the single loaded Wav2Lip engine (torch releases the
+GIL during inference and ffmpeg encodes in its own process), fed by a job
+queue with a hard depth limit so an overloaded server rejects new renders
+instead of piling them up. `run` awaits a job without blocking the event loop.
+"""
+import asyncio
+import concurrent.futures
+import queue
+import threading
+
+
+class QueueFullError(Exception):
+    """Raised when a render is submitted while the queue is at its limit"""
+
+
+class RenderPool:
+    def __init__(self, workers=1, max_queue=8):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._jobs = queue.Queue(maxsize=max_queue)
+        self._active = 0
+        self._lock = threading.Lock()
+
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"render-{i}", daemon=True).start()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue `fn(*args, **kwargs)` and return a concurrent.futures.Future for it"""
+        future = concurrent.futures.Future()
+        try:
+            self._jobs.put_nowait((future, fn, args, kwargs))
+        except queue.Full:
+            raise QueueFullError(f"Render queue is full ({self.max_queue} jobs waiting)")
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        """Queue a job and wait for its result from async code"""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def status(self):
+        return {
+            "workers": self.workers,
+            "active": self._active,
+            "queued": self._jobs.qsize(),
+            "max_queue": self.max_queue,
+        }
+
+    def _work(self):
+        while True:
+            future, fn, args, kwargs = self._jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            with self._lock:
+                self._active += 1
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self._active -= 1
@@ -0,0 +1,109 @@
+"""
+Semantic cache of complete chat turns.
+
+Questions are matched on the cosine similarity of their embeddings, among
+entries with the same role and the same preceding conversation (a fingerprint
+of the last turn, empty at the start of a session), so rephrased opening
+questions share one reply. An entry holds the reply text and, as they become
+available, its summary, book insight, audio file and video file.
+"""
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+
+def history_fingerprint(messages):
+    """Fingerprint of the last user/assistant turn in `messages`"""
+    turn = [m for m in messages if m["role"] in ("user", "assistant")][-2:]
+    if not turn:
+        return ""
+    digest = hashlib.sha256()
+    for message in turn:
+        digest.update(f"{message['role']}\0{message['content']}\0".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+class ResponseCache:
+    def __init__(self, embed, threshold=0.95, max_entries=500, ttl=24 * 3600):
+        self.embed = embed
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _vector(self, text):
+        vector = np.asarray(self.embed(text), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, text, role, fingerprint=""):
+        """The most similar live entry above the threshold as (entry_id, fields), or None"""
+        vector = self._vector(text)
+        with self._lock:
+            self._evict()
+            best_id, best_score = None, self.threshold
+            for entry_id, entry in self._entries.items():
+                if entry["role"] != role or entry["fingerprint"] != fingerprint:
+                    continue
+                score = float(entry["vector"] @ vector)
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best_id)
+            entry = self._entries[best_id]
+            print(f"Response cache hit ({best_score:.3f}): {entry['query']!r}")
+            return best_id, dict(entry["fields"])
+
+    def store(self, text, role, fingerprint="", **fields):
+        """Add a turn and return its entry id, to be completed with `update`"""
+        entry_id = uuid.uuid4().hex
+        entry = {
+            "query": text,
+            "role": role,
+            "fingerprint": fingerprint,
+            "vector": self._vector(text),
+            "fields": fields,
+            "created_at": time.time(),
+        }
+        with self._lock:
+            self._entries[entry_id] = entry
+            self._evict()
+        return entry_id
+
+    def get(self, entry_id):
+        with self._lock:
+            entry = self._entries.get(entry_id)
+            return dict(entry["fields"]) if entry is not None else None
+
+    def update(self, entry_id, **fields):
+        with self._lock:
+            entry = self._entries.get(entry_id)
+            if entry is not None:
+                entry["fields"].update(fields)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+            }
+
+    def _evict(self):
+        cutoff = time.time() - self.ttl
+        for entry_id in [i for i, e in self._entries.items() if e["created_at"] < cutoff]:
+            del self._entries[entry_id]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
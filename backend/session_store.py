@@ -0,0 +1,202 @@
+"""
+Per-user conversation state.
+
+Each client is identified by a session id, sent in the `X-Session-Id` header
+or the `kirk_session` cookie; a new id is issued when neither is present.
+Sessions live in memory with LRU and idle-time eviction. With a backend
+(`SqliteSessionBackend`, or anything with the same get/set/delete methods,
+e.g. a Redis wrapper) they are also written through on every change, so
+several worker processes can serve the same users and sessions survive
+restarts. Every stored state has a version: `get` reloads a session another
+worker has changed, and `save` only writes over the version it last saw,
+otherwise it replays its new turns on top of the stored state and retries.
+"""
+import json
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+SESSION_HEADER = "X-Session-Id"
+SESSION_COOKIE = "kirk_session"
+SESSION_ID = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+
+class Session:
+    def __init__(self, session_id, history):
+        self.id = session_id
+        self.history = history
+        self.latest_audio_file = None
+        self.latest_video_file = None
+        self.last_seen = time.time()
+        # Backend version this state is based on, and turns added since
+        self.version = 0
+        self._new_turns = []
+
+    def add_turn(self, user_text, assistant_text):
+        self.history.add_turn(user_text, assistant_text)
+        self._new_turns.append((user_text, assistant_text))
+
+    def to_dict(self):
+        return {
+            "history": self.history.to_dict(),
+            "latest_audio_file": self.latest_audio_file,
+            "latest_video_file": self.latest_video_file,
+        }
+
+    def restore(self, state):
+        self.history.restore(state.get("history", {}))
+        self.latest_audio_file = state.get("latest_audio_file")
+        self.latest_video_file = state.get("latest_video_file")
+
+    def rebase(self, state, version):
+        """Take the stored `state` and replay the turns added here on top of it"""
+        latest = (self.latest_audio_file, self.latest_video_file)
+        self.restore(state)
+        for user_text, assistant_text in self._new_turns:
+            self.history.add_turn(user_text, assistant_text)
+        if self._new_turns:
+            self.latest_audio_file = latest[0] or self.latest_audio_file
+            self.latest_video_file = latest[1] or self.latest_video_file
+        self.version = version
+
+
+class SqliteSessionBackend:
+    """Versioned session state as JSON rows in a sqlite file"""
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions "
+            "(id TEXT PRIMARY KEY, state TEXT, updated_at REAL, version INTEGER NOT NULL DEFAULT 1)"
+        )
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(sessions)")]
+        if "version" not in columns:
+            self._db.execute("ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        """(state, version) of the session, or None"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT state, version FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def set(self, session_id, state, version):
+        """Store `state` if the stored version is still `version` (0: not stored yet);
+        return the new version, or None if another writer got there first"""
+        with self._lock:
+            if version == 0:
+                cursor = self._db.execute(
+                    "INSERT OR IGNORE INTO sessions (id, state, updated_at, version) VALUES (?, ?, ?, 1)",
+                    (session_id, json.dumps(state), time.time()),
+                )
+            else:
+                cursor = self._db.execute(
+                    "UPDATE sessions SET state = ?, updated_at = ?, version = version + 1 "
+                    "WHERE id = ? AND version = ?",
+                    (json.dumps(state), time.time(), session_id, version),
+                )
+            self._db.commit()
+        return version + 1 if cursor.rowcount == 1 else None
+
+    def delete(self, session_id):
+        with self._lock:
+            self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            self._db.commit()
+
+
+class SessionStore:
+    """Sessions in memory, dropping the least recently used beyond `max_sessions` or after `ttl` idle seconds"""
+
+    def __init__(self, new_history, max_sessions=1000, ttl=6 * 3600, backend=None):
+        self.new_history = new_history
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.backend = backend
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id=None):
+        """The session for `session_id`, or a new one if it is unknown or invalid"""
+        if not session_id or not SESSION_ID.match(session_id):
+            session_id = uuid.uuid4().hex
+
+        with self._lock:
+            self._evict()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                session.last_seen = time.time()
+
+        if session is None:
+            session = Session(session_id, self.new_history())
+            with self._lock:
+                # Another request may have created it meanwhile
+                session = self._sessions.setdefault(session_id, session)
+                self._sessions.move_to_end(session_id)
+
+        # Pick up turns other workers have stored since this one last synced
+        if self.backend is not None:
+            try:
+                stored = self.backend.get(session_id)
+                if stored is not None and stored[1] != session.version:
+                    session.rebase(*stored)
+            except Exception as e:
+                print(f"Error loading session {session_id}: {str(e)}")
+        return session
+
+    def save(self, session, attempts=3):
+        """Write the session through to the backend after it changed, without
+        overwriting what another worker stored in the meantime"""
+        if self.backend is None:
+            session._new_turns = []
+            return
+        try:
+            for _ in range(attempts):
+                version = self.backend.set(session.id, session.to_dict(), session.version)
+                if version is not None:
+                    session.version = version
+                    session._new_turns = []
+                    return
+                stored = self.backend.get(session.id)
+                if stored is None:
+                    # Deleted meanwhile; store ours as a new session
+                    session.version = 0
+                else:
+                    session.rebase(*stored)
+            print(f"Error saving session {session.id}: too many concurrent writes")
+        except Exception as e:
+            print(f"Error saving session {session.id}: {str(e)}")
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        if self.backend is not None:
+            self.backend.delete(session_id)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _evict(self):
+        cutoff = time.time() - self.ttl
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if len(self._sessions) < self.max_sessions and oldest.last_seen > cutoff:
+                break
+            self._sessions.popitem(last=False)
+
+
+def session_id_from(request):
+    """Session id sent by the client, header first, then cookie"""
+    return request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+
+
+def attach(response, session):
+    """Tell the client which session served it"""
+    response.headers[SESSION_HEADER] = session.id
+    response.set_cookie(SESSION_COOKIE, session.id, max_age=30 * 24 * 3600, httponly=True, samesite="lax")
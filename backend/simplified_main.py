@@ -1,16 +1,16 @@
 import os
 import sys
-import cv2
-import subprocess
 import time
 import shutil
 import uuid
+import tempfile
 from pathlib import Path
 import glob
 
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 
 # Add voice_to_voice directory to Python path
@@ -19,9 +19,15 @@ sys.path.append(voice_to_voice_path)
 
 # Import from voice_to_voice directory
 from voice_to_voice.advisor import speak_text_with_elevenlabs
-from voice_to_voice.kirk_agent import get_kirk_text
+from voice_to_voice.kirk_agent import get_kirk_text, client as kirk_client
 from voice_to_voice.config import SYSTEM_PROMPT
 from voice_to_voice.speech_to_text import transcribe_audio as whisper_transcribe
+from wav2lip_engine import Wav2LipEngine
+from avatar_registry import AvatarRegistry
+import video_stream
+from render_pool import RenderPool, QueueFullError
+from history import ConversationHistory, summarize_with
+from session_store import SessionStore, SqliteSessionBackend, SESSION_HEADER, attach, session_id_from
 
 # Get the directory where this script is located
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -37,10 +43,6 @@ results_dir = os.path.join(script_dir, 'results')
 for dir_path in [audio_dir, video_dir, library_dir, temp_dir, results_dir]:
     os.makedirs(dir_path, exist_ok=True)
 
-# Create temporary working directory with no spaces
-temp_working_dir = "/tmp/wav2lip_temp"
-os.makedirs(temp_working_dir, exist_ok=True)
-
 # Initialize FastAPI app
 app = FastAPI()
 
@@ -51,84 +53,88 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[SESSION_HEADER],
 )
 
-# Initialize conversation history
-chat_history = [{"role": "system", "content": SYSTEM_PROMPT}]
+def new_history():
+    """Conversation history of a session: recent turns within a token budget plus
+    a rolling summary of older ones"""
+    return ConversationHistory(
+        system_prompt=SYSTEM_PROMPT,
+        summarize=summarize_with(kirk_client),
+        token_budget=int(os.getenv("HISTORY_TOKEN_BUDGET", "3000")),
+        model="gpt-3.5-turbo",
+    )
+
+# One conversation per client session; SESSION_DB shares them between workers
+sessions = SessionStore(
+    new_history,
+    max_sessions=int(os.getenv("MAX_SESSIONS", "1000")),
+    ttl=int(os.getenv("SESSION_TTL", str(6 * 3600))),
+    backend=SqliteSessionBackend(os.getenv("SESSION_DB")) if os.getenv("SESSION_DB") else None,
+)
 
-# Track latest generated files
-latest_audio_file = None
-latest_video_file = None
+# Resident Wav2Lip engine, prepared avatars and render workers, loaded at startup
+wav2lip_engine = None
+avatar_registry = None
+render_pool = None
 
 class SpeechRequest(BaseModel):
     text: str
+    stream: bool = False
 
-def run_wav2lip(audio_path, avatar_path=None):
-    """Run the Wav2Lip model to generate a lip-synced video using the simplified approach"""
-    print(f"Starting Wav2Lip with audio: {audio_path}")
-    
-    # Use the specified avatar or default
-    if not avatar_path:
-        avatar_path = os.path.join(library_dir, "avatar.jpeg")
+def get_default_avatar_path():
+    """Find the avatar image in the library directory"""
+    avatar_path = os.path.join(library_dir, "avatar.jpeg")
+    if not os.path.exists(avatar_path):
+        # Try png as fallback
+        avatar_path = os.path.join(library_dir, "avatar.png")
         if not os.path.exists(avatar_path):
-            # Try png as fallback
-            avatar_path = os.path.join(library_dir, "avatar.png")
-            if not os.path.exists(avatar_path):
-                raise FileNotFoundError(f"No avatar found at {avatar_path}")
-    
-    # Generate unique output filename
+            raise FileNotFoundError(f"No avatar found at {avatar_path}")
+    return avatar_path
+
+def new_audio_path():
+    """Unique path for a synthesized reply so concurrent requests never share it"""
+    return os.path.join(audio_dir, f"{uuid.uuid4()}.mp3")
+
+def new_video_path():
+    """Generate unique output filename"""
     timestamp = time.strftime("%Y%m%d_%H%M%S")
     unique_id = str(uuid.uuid4())[:8]
-    output_path = os.path.join(video_dir, f"result_{timestamp}_{unique_id}.mp4")
-    
-    # Optimize image resolution
-    img = cv2.imread(avatar_path)
-    height, width = img.shape[:2]
-    aspect_ratio = width / height
-    new_height = int(256 / aspect_ratio)
-    resized = cv2.resize(img, (256, new_height))
-    optimized_image = os.path.join(temp_dir, 'optimized_avatar.jpeg')
-    cv2.imwrite(optimized_image, resized)
-    
-    # Find Wav2Lip directory (case insensitive)
-    if os.path.exists(os.path.join(script_dir, 'wav2lip')):
-        wav2lip_dir = os.path.join(script_dir, 'wav2lip')
-    elif os.path.exists(os.path.join(script_dir, 'Wav2Lip')):
-        wav2lip_dir = os.path.join(script_dir, 'Wav2Lip')
-    else:
-        raise FileNotFoundError("Wav2Lip directory not found")
-    
-    # Copy files to the temporary directory
-    temp_audio = os.path.join(temp_working_dir, f"input_{unique_id}.mp3")
-    temp_image = os.path.join(temp_working_dir, f"face_{unique_id}.jpeg")
-    temp_output = os.path.join(temp_working_dir, f"output_{unique_id}.mp4")
-    
-    shutil.copy2(audio_path, temp_audio)
-    shutil.copy2(optimized_image, temp_image)
-    
-    # Set paths
-    inference_path = os.path.join(wav2lip_dir, 'inference.py')
-    checkpoint_path = os.path.join(wav2lip_dir, 'checkpoints', 'wav2lip_gan.pth')
-    
-    # Basic command with paths that don't have spaces
-    command = [
-        'python', inference_path,
-        '--checkpoint_path', checkpoint_path,
-        '--face', temp_image,
-        '--audio', temp_audio,
-        '--outfile', temp_output,
-        '--pads', '0', '5', '0', '0',
-        '--nosmooth'
-    ]
-    
+    return os.path.join(video_dir, f"result_{timestamp}_{unique_id}.mp4")
+
+def run_wav2lip(audio_path, avatar_path=None, output_path=None, fragmented=False):
+    """Run the resident Wav2Lip engine to generate a lip-synced video"""
+    print(f"Starting Wav2Lip with audio: {audio_path}")
+
+    if wav2lip_engine is None:
+        print("Wav2Lip engine is not loaded")
+        return None
+
+    if not output_path:
+        output_path = new_video_path()
+
     # Run Wav2Lip
     print("Running Wav2Lip...")
     try:
-        subprocess.run(command, check=True)
-        
-        # Copy the result back if it exists
-        if os.path.exists(temp_output):
-            shutil.copy2(temp_output, output_path)
+        # Use the specified avatar or the current prepared one
+        if avatar_path:
+            avatar = avatar_registry.register_file(avatar_path, make_current=False)
+        elif avatar_registry.current is not None:
+            avatar = avatar_registry.current
+        else:
+            avatar = avatar_registry.register_file(get_default_avatar_path())
+
+        # Render inside a per-job scratch directory so concurrent jobs never share
+        # files and only complete videos appear in the video directory. Streaming
+        # renders write in place since the client reads them while they grow.
+        with tempfile.TemporaryDirectory(prefix="job_", dir=temp_dir) as scratch_dir:
+            render_path = output_path if fragmented else os.path.join(scratch_dir, "result.mp4")
+            wav2lip_engine.generate(audio_path, avatar, render_path, fragmented=fragmented)
+            if render_path != output_path:
+                os.replace(render_path, output_path)
+
+        if os.path.exists(output_path):
             print(f"Success! Output saved to: {output_path}")
             return os.path.basename(output_path)
         else:
@@ -136,17 +142,71 @@ def run_wav2lip(audio_path, avatar_path=None):
             return None
     except Exception as e:
         print(f"Error running Wav2Lip: {str(e)}")
+        # A failed streaming render leaves a cut-off file behind
+        if fragmented and os.path.exists(output_path):
+            os.remove(output_path)
+        return None
+
+def start_streaming_render(audio_path):
+    """Queue a fragmented render and return the path it is written to and its future"""
+    if render_pool is None:
+        return None
+
+    video_path = new_video_path()
+    try:
+        future = render_pool.submit(run_wav2lip, audio_path, output_path=video_path, fragmented=True)
+    except QueueFullError as e:
+        print(f"Error queueing Wav2Lip: {str(e)}")
+        return None
+
+    video_stream.track(video_path, future)
+    return video_path, future
+
+async def render_video(audio_path):
+    """Render on the worker pool without blocking the event loop"""
+    if render_pool is None:
+        print("Wav2Lip engine is not loaded")
+        return None
+
+    try:
+        return await render_pool.run(run_wav2lip, audio_path)
+    except QueueFullError as e:
+        print(f"Error queueing Wav2Lip: {str(e)}")
         return None
 
-def get_or_create_reply_file():
-    """Find or create a reply.mp3 file in the audio directory"""
+@app.on_event("startup")
+def load_wav2lip_engine():
+    """Load the Wav2Lip model and face detector once for the lifetime of the server"""
+    global wav2lip_engine, avatar_registry, render_pool
+    try:
+        wav2lip_engine = Wav2LipEngine(
+            pads=(0, 5, 0, 0),
+            nosmooth=True,
+            preset=os.getenv("WAV2LIP_PRESET", "veryfast"),
+            crf=int(os.getenv("WAV2LIP_CRF", "23")),
+        )
+        avatar_registry = AvatarRegistry(wav2lip_engine)
+        render_pool = RenderPool(
+            workers=int(os.getenv("WAV2LIP_WORKERS", "1")),
+            max_queue=int(os.getenv("WAV2LIP_MAX_QUEUE", "8")),
+        )
+    except Exception as e:
+        print(f"Error loading Wav2Lip engine: {str(e)}")
+        return
+
+    # Detect the face of the library avatar before the first request
+    try:
+        avatar_registry.register_file(get_default_avatar_path())
+    except Exception as e:
+        print(f"Error preparing default avatar: {str(e)}")
+
+def get_or_create_reply_file(session):
+    """Find the session's latest reply, or a reply.mp3 file in the audio directory"""
     reply_path = os.path.join(audio_dir, "reply.mp3")
     
-    # If we have a recent audio file, use that
-    global latest_audio_file
-    if latest_audio_file and os.path.exists(latest_audio_file):
-        shutil.copy2(latest_audio_file, reply_path)
-        return reply_path
+    # If the session has a recent audio file, use that
+    if session.latest_audio_file and os.path.exists(session.latest_audio_file):
+        return session.latest_audio_file
     
     # If reply.mp3 already exists, return it
     if os.path.exists(reply_path):
@@ -177,7 +237,7 @@ async def transcribe_uploaded_audio(file: UploadFile = File(...)):
             f.write(content)
         
         # Transcribe using Whisper
-        transcript = whisper_transcribe(file_path)
+        transcript = await run_in_threadpool(whisper_transcribe, file_path)
         print(f"Transcription successful: {transcript}")
         
         # Return the transcription
@@ -188,24 +248,27 @@ async def transcribe_uploaded_audio(file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/generate-speech")
-async def generate_speech(request: SpeechRequest):
+async def generate_speech(request: SpeechRequest, http_request: Request, response: Response):
     try:
+        session = sessions.get(session_id_from(http_request))
+        attach(response, session)
         print(f"Generating speech for text: {request.text}")
         
         # Get Kirk's response using GPT
-        chat_history.append({"role": "user", "content": request.text})
-        kirk_response = get_kirk_text(request.text, chat_history)
-        chat_history.append({"role": "assistant", "content": kirk_response})
+        kirk_response = await run_in_threadpool(get_kirk_text, request.text, session.history.window())
+        session.add_turn(request.text, kirk_response)
         
         # Generate speech using ElevenLabs
-        audio_filepath = speak_text_with_elevenlabs(kirk_response, play_audio=False)
+        audio_filepath = await run_in_threadpool(
+            speak_text_with_elevenlabs, kirk_response, play_audio=False, filename=new_audio_path()
+        )
         
         if not audio_filepath:
             raise HTTPException(status_code=500, detail="Failed to generate speech")
         
         # Store the latest audio file for reply.mp3 endpoint
-        global latest_audio_file
-        latest_audio_file = audio_filepath
+        session.latest_audio_file = audio_filepath
+        sessions.save(session)
         
         # Also create reply.mp3 for compatibility
         reply_path = os.path.join(audio_dir, "reply.mp3")
@@ -223,24 +286,27 @@ async def generate_speech(request: SpeechRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/generate-video")
-async def generate_video(request: SpeechRequest):
+async def generate_video(request: SpeechRequest, http_request: Request, response: Response):
     try:
+        session = sessions.get(session_id_from(http_request))
+        attach(response, session)
         print(f"Generating video for text: {request.text}")
         
         # Get Kirk's response using GPT
-        chat_history.append({"role": "user", "content": request.text})
-        kirk_response = get_kirk_text(request.text, chat_history)
-        chat_history.append({"role": "assistant", "content": kirk_response})
+        kirk_response = await run_in_threadpool(get_kirk_text, request.text, session.history.window())
+        session.add_turn(request.text, kirk_response)
         
         # Generate speech using ElevenLabs
-        audio_filepath = speak_text_with_elevenlabs(kirk_response, play_audio=False)
+        audio_filepath = await run_in_threadpool(
+            speak_text_with_elevenlabs, kirk_response, play_audio=False, filename=new_audio_path()
+        )
         
         if not audio_filepath:
             raise HTTPException(status_code=500, detail="Failed to generate speech")
         
         # Store the latest audio file for reply.mp3 endpoint
-        global latest_audio_file
-        latest_audio_file = audio_filepath
+        session.latest_audio_file = audio_filepath
+        sessions.save(session)
         
         # Also create reply.mp3 for compatibility
         reply_path = os.path.join(audio_dir, "reply.mp3")
@@ -250,12 +316,30 @@ async def generate_video(request: SpeechRequest):
         audio_filename = os.path.basename(audio_filepath)
         
         # Run simplified Wav2Lip
-        video_filename = run_wav2lip(audio_filepath)
+        if request.stream:
+            # Render in the background and let the client play the
+            # fragmented mp4 while later frames are still being generated
+            render = start_streaming_render(audio_filepath)
+        else:
+            render = None
+
+        if render is not None:
+            video_path, _ = render
+            session.latest_video_file = video_path
+            sessions.save(session)
+
+            return {
+                "audio_url": f"/audio/{audio_filename}",
+                "video_url": f"/video/stream/{os.path.basename(video_path)}",
+                "text": kirk_response,
+            }
+
+        video_filename = await render_video(audio_filepath)
         
         if video_filename:
             # Store the latest video file
-            global latest_video_file
-            latest_video_file = os.path.join(video_dir, video_filename)
+            session.latest_video_file = os.path.join(video_dir, video_filename)
+            sessions.save(session)
             
             return {
                 "audio_url": f"/audio/{audio_filename}",
@@ -275,11 +359,11 @@ async def generate_video(request: SpeechRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/audio/reply.mp3")
-async def get_reply_audio():
+async def get_reply_audio(http_request: Request):
     """Specialized endpoint for compatibility with old frontend"""
     try:
         print("Requesting /audio/reply.mp3")
-        reply_path = get_or_create_reply_file()
+        reply_path = get_or_create_reply_file(sessions.get(session_id_from(http_request)))
         
         if not reply_path or not os.path.exists(reply_path):
             raise HTTPException(status_code=404, detail="No audio file available")
@@ -305,6 +389,15 @@ async def get_audio(filename: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/video/stream/{filename}")
+async def stream_video(filename: str):
+    """Serve a video progressively while it is still being rendered"""
+    video_path = os.path.join(video_dir, filename)
+    if not video_stream.is_rendering(video_path) and not os.path.exists(video_path):
+        raise HTTPException(status_code=404, detail="Video file not found")
+
+    return StreamingResponse(video_stream.follow(video_path), media_type="video/mp4")
+
 @app.get("/video/{filename}")
 async def get_video(filename: str):
     try:
@@ -334,8 +427,16 @@ async def upload_avatar(file: UploadFile = File(...)):
         avatar_jpeg_path = os.path.join(library_dir, "avatar.jpeg")
         avatar_png_path = os.path.join(library_dir, "avatar.png")
         
-        # Read and save file
         content = await file.read()
+
+        # Detect and prepare the face once so generations can skip it. Face
+        # detection blocks, and an image without a face must not replace the
+        # default avatar, so the files are only written once it succeeded.
+        avatar = None
+        if avatar_registry is not None:
+            avatar = await run_in_threadpool(avatar_registry.register_bytes, content)
+
+        # Read and save file
         with open(avatar_jpeg_path, 'wb') as f:
             f.write(content)
         
@@ -343,38 +444,44 @@ async def upload_avatar(file: UploadFile = File(...)):
         with open(avatar_png_path, 'wb') as f:
             f.write(content)
         
+        if avatar is not None:
+            return {"message": "Avatar uploaded successfully", "avatar_id": avatar.key}
         return {"message": "Avatar uploaded successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/test-video")
-async def test_video():
+async def test_video(http_request: Request, response: Response):
     """Test endpoint to generate a simple test video"""
     try:
+        session = sessions.get(session_id_from(http_request))
+        attach(response, session)
         # Generate a test audio
         test_text = "This is a test of the lip sync system."
-        audio_filepath = speak_text_with_elevenlabs(test_text, play_audio=False)
+        audio_filepath = await run_in_threadpool(
+            speak_text_with_elevenlabs, test_text, play_audio=False, filename=new_audio_path()
+        )
         
         if not audio_filepath:
             raise HTTPException(status_code=500, detail="Failed to generate test audio")
         
         # Store the latest audio file for reply.mp3 endpoint
-        global latest_audio_file
-        latest_audio_file = audio_filepath
+        session.latest_audio_file = audio_filepath
+        sessions.save(session)
         
         # Also create reply.mp3 for compatibility
         reply_path = os.path.join(audio_dir, "reply.mp3")
         shutil.copy2(audio_filepath, reply_path)
         
         # Run simplified Wav2Lip
-        video_filename = run_wav2lip(audio_filepath)
+        video_filename = await render_video(audio_filepath)
         
         if not video_filename:
             raise HTTPException(status_code=500, detail="Failed to generate test video")
         
         # Store the latest video file
-        global latest_video_file
-        latest_video_file = os.path.join(video_dir, video_filename)
+        session.latest_video_file = os.path.join(video_dir, video_filename)
+        sessions.save(session)
             
         return {
             "video_url": f"/video/{video_filename}",
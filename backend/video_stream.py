@@ -0,0 +1,68 @@
+"""
+Progressive delivery of files that are still being written.
+
+A streaming render writes a fragmented mp4 on the render pool; `follow`
+serves that file to the client as it grows and finishes once the render is
+done, so playback can start after the first fragment instead of at the end.
+Speech streamed from ElevenLabs is followed the same way while it is
+written to the TTS cache.
+"""
+import asyncio
+import os
+import threading
+
+# Output path -> event set when the render writing it has finished
+_renders = {}
+_lock = threading.Lock()
+
+
+def track(output_path, future):
+    """Serve `output_path` progressively until the render `future` completes"""
+    done = threading.Event()
+    with _lock:
+        _renders[output_path] = done
+
+    def finished(f):
+        if f.exception() is not None:
+            print(f"Error writing {output_path}: {str(f.exception())}")
+        done.set()
+        with _lock:
+            # A later job may have taken over the same path
+            if _renders.get(output_path) is done:
+                del _renders[output_path]
+
+    future.add_done_callback(finished)
+
+
+def is_rendering(output_path):
+    with _lock:
+        return output_path in _renders
+
+
+async def follow(output_path, chunk_size=64 * 1024, poll_interval=0.1):
+    """Yield the bytes of `output_path`, waiting for new data until its render is done"""
+    with _lock:
+        done = _renders.get(output_path)
+
+    def finished():
+        return done is None or done.is_set()
+
+    # ffmpeg creates the file once it has started encoding
+    while not os.path.exists(output_path):
+        if finished():
+            return
+        await asyncio.sleep(poll_interval)
+
+    with open(output_path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if chunk:
+                yield chunk
+                continue
+            if finished():
+                # Pick up anything written between the last read and the end
+                rest = f.read()
+                if rest:
+                    yield rest
+                break
+            await asyncio.sleep(poll_interval)
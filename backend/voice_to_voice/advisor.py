@@ -1,32 +1,39 @@
 import os
-import requests
 import pygame
 import time
+import shutil
 from config import ELEVEN_LABS_API_KEY, ELEVEN_LABS_VOICE_ID
+from tts_cache import TTSCache
+import tts_client as elevenlabs
 
+# Synthesized clips are reused for identical text and voice, within the same
+# TTS_CACHE_MB cap as main.py
+tts_cache = TTSCache(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "tts_cache"),
+    max_bytes=int(os.getenv("TTS_CACHE_MB", "500")) * 1024 * 1024,
+)
 
-def speak_text_with_elevenlabs(text, play_audio=True):
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{ELEVEN_LABS_VOICE_ID}/stream"
+# Keeps the connection to ElevenLabs alive between replies; timeouts and
+# retries come from the same TTS_* settings as main.py
+tts_client = elevenlabs.from_env(
+    voice_id=os.getenv("ELEVENLABS_VOICE_ID") or ELEVEN_LABS_VOICE_ID,
+    api_key=ELEVEN_LABS_API_KEY,
+)
 
-    payload = {
-        "text": text,
-        "voice_settings": {
-            "stability": 0.2,
-            "similarity_boost": 0.95,
-            "style": 0.5,
-            "use_speaker_boost": True,
-        },
-    }
-    headers = {"xi-api-key": ELEVEN_LABS_API_KEY}
 
-    response = requests.post(url, json=payload, headers=headers)
-    if response.status_code != 200:
-        print("🔴 Failed to generate speech:", response.text)
+def speak_text_with_elevenlabs(text, play_audio=True, filename="reply.mp3"):
+    try:
+        cached_path = tts_cache.get_or_synthesize(
+            text,
+            tts_client.voice_id,
+            tts_client.voice_settings,
+            lambda path: tts_client.synthesize_to(text, path),
+        )
+    except Exception as e:
+        print("🔴 Failed to generate speech:", e)
         return
 
-    filename = "reply.mp3"
-    with open(filename, "wb") as f:
-        f.write(response.content)
+    shutil.copyfile(cached_path, filename)
 
     if play_audio:
         print(f"🔊 Playing: {filename}")
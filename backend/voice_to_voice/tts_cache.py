@@ -0,0 +1,215 @@
+# tts_cache.py
+
+import hashlib
+import json
+import os
+import subprocess
+import threading
+import time
+
+# Wav2Lip works on mono 16 kHz audio
+WAV_SAMPLE_RATE = 16000
+
+
+class LRUFileIndex:
+    """
+    Sizes and last use of the entries of an on-disk cache, saved as JSON so
+    the size cap survives restarts. `files(key)` returns the files of an
+    entry, the main one first; beyond `max_bytes` the least recently used
+    entries and their files are deleted. Callers serialize access with
+    their own lock.
+    """
+
+    def __init__(self, path, max_bytes, files):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.files = files
+        self.entries = self._load()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def total_bytes(self):
+        return sum(entry["bytes"] for entry in self.entries.values())
+
+    def touch(self, key):
+        """Mark `key` as used; False if it is not cached (any more)"""
+        if key not in self.entries or not os.path.exists(self.files(key)[0]):
+            return False
+        self.entries[key]["last_used"] = time.time()
+        self.save()
+        return True
+
+    def add(self, key, nbytes):
+        """Record `nbytes` more for `key` and evict others to make room for it"""
+        entry = self.entries.setdefault(key, {"bytes": 0})
+        entry["bytes"] += nbytes
+        entry["last_used"] = time.time()
+        self._evict(keep=key)
+        self.save()
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            entries = {}
+        # Drop entries whose files were removed while the server was down
+        return {
+            key: entry for key, entry in entries.items()
+            if os.path.exists(self.files(key)[0])
+        }
+
+    def _evict(self, keep=None):
+        total = self.total_bytes()
+        for key in sorted(self.entries, key=lambda k: self.entries[k]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self.entries.pop(key)["bytes"]
+            for path in self.files(key):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+class TTSCache:
+    """
+    Content-addressed cache of synthesized speech.
+
+    Each clip is stored as `tts_<key>.mp3`, where the key hashes the text, the
+    voice id and the voice settings, next to a `tts_<key>.wav` decoded to
+    mono 16 kHz for Wav2Lip on first use. `tts_index.json` records sizes and
+    last use for the LRU size cap.
+    """
+
+    def __init__(self, cache_dir, max_bytes=500 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pending = {}
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index = LRUFileIndex(
+            os.path.join(cache_dir, "tts_index.json"),
+            max_bytes,
+            lambda key: [self.mp3_path(key), self._wav_path(key)],
+        )
+
+    @staticmethod
+    def key(text, voice_id, voice_settings):
+        payload = json.dumps(
+            {"text": text, "voice_id": voice_id, "voice_settings": voice_settings},
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+    def mp3_path(self, key):
+        return os.path.join(self.cache_dir, f"tts_{key}.mp3")
+
+    def partial_path(self, key):
+        """Where the mp3 is written while it is being synthesized"""
+        return f"{self.mp3_path(key)}.part"
+
+    def is_pending(self, key):
+        with self._lock:
+            return key in self._pending
+
+    def _wav_path(self, key):
+        return os.path.join(self.cache_dir, f"tts_{key}.wav")
+
+    def get_or_synthesize(self, text, voice_id, voice_settings, synthesize):
+        """
+        Path of the mp3 for this text and voice, calling `synthesize(path)`
+        to write the mp3 to `path` only when it is not cached. Concurrent
+        calls for the same clip wait for the first one instead of
+        synthesizing it again.
+        """
+        key = self.key(text, voice_id, voice_settings)
+        path = self.mp3_path(key)
+
+        with self._lock:
+            if self._index.touch(key):
+                self.hits += 1
+                return path
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = threading.Event()
+                self.misses += 1
+                owner = True
+            else:
+                self.hits += 1
+                owner = False
+
+        if not owner:
+            pending.wait()
+            if not os.path.exists(path):
+                raise RuntimeError("Speech synthesis failed")
+            return path
+
+        # Written under `partial_path` so readers never take a partial clip for
+        # a finished one; streaming readers follow that file while it grows
+        partial_path = self.partial_path(key)
+        try:
+            synthesize(partial_path)
+            os.replace(partial_path, path)
+            with self._lock:
+                self._index.add(key, os.path.getsize(path))
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            with self._lock:
+                self._pending.pop(key, None)
+            pending.set()
+        return path
+
+    def wav_for(self, mp3_path):
+        """
+        16 kHz mono wav of a cached mp3, decoded once; None if `mp3_path` is not from this cache.
+        """
+        name = os.path.basename(mp3_path)
+        if os.path.dirname(os.path.abspath(mp3_path)) != os.path.abspath(self.cache_dir):
+            return None
+        if not (name.startswith("tts_") and name.endswith(".mp3")):
+            return None
+        key = name[len("tts_"):-len(".mp3")]
+        wav_path = self._wav_path(key)
+        if os.path.exists(wav_path):
+            return wav_path
+
+        tmp_path = f"{wav_path}.tmp-{threading.get_ident()}.wav"
+        subprocess.run(
+            ["ffmpeg", "-y", "-loglevel", "error", "-i", mp3_path,
+             "-ac", "1", "-ar", str(WAV_SAMPLE_RATE), tmp_path],
+            check=True,
+        )
+        os.replace(tmp_path, wav_path)
+
+        with self._lock:
+            if key in self._index:
+                # The clip is about to be rendered, so it is never the one evicted
+                self._index.add(key, os.path.getsize(wav_path))
+        return wav_path
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "clips": len(self._index),
+                "bytes": self._index.total_bytes(),
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,129 @@
+# tts_client.py
+
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+API_URL = "https://api.elevenlabs.io/v1/text-to-speech"
+
+# Kirk's voice, shared by every server
+DEFAULT_VOICE_SETTINGS = {
+    "stability": 0.2,
+    "similarity_boost": 0.95,
+    "style": 0.5,
+    "use_speaker_boost": True,
+}
+
+# Worth another try: rate limiting and transient upstream errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TTSError(RuntimeError):
+    """ElevenLabs rejected the request or kept failing after all retries"""
+
+
+class ElevenLabsClient:
+    """
+    Shared ElevenLabs text-to-speech client.
+
+    One `requests.Session` keeps connections to the API alive between turns,
+    so only the first request pays for the TCP and TLS handshakes. Connection
+    errors, timeouts and 429/5xx responses are retried with jittered
+    exponential backoff, as long as no audio has been received yet. Audio is
+    read from the `/stream` endpoint chunk by chunk instead of being buffered.
+    """
+
+    def __init__(self, api_key, voice_id, voice_settings=None, connect_timeout=5,
+                 read_timeout=30, retries=3, backoff=0.5, pool_size=8, chunk_size=16 * 1024):
+        self.api_key = api_key
+        self.voice_id = voice_id
+        self.voice_settings = dict(voice_settings or DEFAULT_VOICE_SETTINGS)
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retried = 0
+
+    def stream(self, text):
+        """Yield the mp3 bytes of `text` as they arrive from ElevenLabs"""
+        response = self._open(text)
+        with response:
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                if chunk:
+                    yield chunk
+
+    def synthesize_to(self, text, path):
+        """Write the mp3 of `text` to `path` as it arrives and return the number of bytes"""
+        size = 0
+        with open(path, "wb") as f:
+            for chunk in self.stream(text):
+                f.write(chunk)
+                size += len(chunk)
+        return size
+
+    def _open(self, text):
+        if not self.api_key:
+            raise TTSError("ELEVENLABS_API_KEY not set")
+
+        url = f"{API_URL}/{self.voice_id}/stream"
+        payload = {"text": text, "voice_settings": self.voice_settings}
+        headers = {"xi-api-key": self.api_key, "Accept": "audio/mpeg"}
+
+        with self._lock:
+            self.requests += 1
+
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            try:
+                response = self._session.post(
+                    url, json=payload, headers=headers, timeout=self.timeout, stream=True
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if last_attempt:
+                    raise TTSError(f"Error generating speech: {str(e)}")
+                self._wait(attempt, f"{type(e).__name__}")
+                continue
+
+            if response.status_code == 200:
+                return response
+
+            # The error body is small; read it so the connection can be reused
+            detail = response.text
+            response.close()
+            if response.status_code not in RETRY_STATUSES or last_attempt:
+                raise TTSError(f"Error generating speech: {detail}")
+            self._wait(attempt, f"HTTP {response.status_code}", response.headers.get("Retry-After"))
+
+    def _wait(self, attempt, reason, retry_after=None):
+        delay = self.backoff * (2 ** attempt)
+        delay = random.uniform(delay / 2, delay * 1.5)
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        with self._lock:
+            self.retried += 1
+        print(f"ElevenLabs request failed ({reason}), retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+    def stats(self):
+        return {"requests": self.requests, "retries": self.retried}
+
+
+def from_env(voice_id=None, api_key=None):
+    """Client configured from ELEVENLABS_API_KEY / ELEVENLABS_VOICE_ID and the TTS_* timeouts"""
+    return ElevenLabsClient(
+        api_key=api_key or os.getenv("ELEVENLABS_API_KEY"),
+        voice_id=voice_id or os.getenv("ELEVENLABS_VOICE_ID", "5ERbh3mpIEzi6sfFHo7H"),
+        connect_timeout=float(os.getenv("TTS_CONNECT_TIMEOUT", "5")),
+        read_timeout=float(os.getenv("TTS_READ_TIMEOUT", "30")),
+        retries=int(os.getenv("TTS_RETRIES", "3")),
+    )
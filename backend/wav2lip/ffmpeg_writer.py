@@ -0,0 +1,55 @@
+import subprocess
+
+
+class FFmpegWriter:
+    """Encode raw BGR frames with a single ffmpeg process fed through stdin.
+
+    With `fragmented=True` the mp4 is written as a sequence of self-contained
+    fragments (one per keyframe interval), so the file can be played while it
+    is still being written.
+    """
+
+    def __init__(self, output_path, frame_size, fps, audio_path=None,
+                 fragmented=False, preset='veryfast', crf=23):
+        frame_w, frame_h = frame_size
+        command = [
+            'ffmpeg', '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+            '-s', '{}x{}'.format(frame_w, frame_h), '-r', str(fps), '-i', '-',
+        ]
+        if audio_path is not None:
+            command += ['-i', audio_path]
+
+        # libx264 with yuv420p needs even dimensions
+        command += [
+            '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2',
+            '-c:v', 'libx264', '-preset', preset, '-crf', str(crf), '-pix_fmt', 'yuv420p',
+        ]
+        if audio_path is not None:
+            command += ['-c:a', 'aac']
+
+        if fragmented:
+            # A keyframe, and therefore a fragment, every second
+            command += ['-g', str(int(round(fps))),
+                        '-movflags', 'frag_keyframe+empty_moov+default_base_moof']
+        else:
+            command += ['-movflags', '+faststart']
+
+        command.append(output_path)
+        self.output_path = output_path
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        self.process.stdin.write(frame.tobytes())
+
+    def flush(self):
+        self.process.stdin.flush()
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError('ffmpeg failed to encode {}'.format(self.output_path))
+
+    def abort(self):
+        self.process.kill()
+        self.process.wait()
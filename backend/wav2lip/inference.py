@@ -1,12 +1,12 @@
 from os import listdir, path
 import numpy as np
 import scipy, cv2, os, sys, argparse, audio
-import json, subprocess, random, string
+import json, subprocess, random, string, tempfile, shutil
 from tqdm import tqdm
 from glob import glob
 import torch, face_detection
 from models import Wav2Lip
-import platform
+from ffmpeg_writer import FFmpegWriter
 
 parser = argparse.ArgumentParser(description='Inference code to lip-sync videos in the wild using Wav2Lip models')
 
@@ -50,6 +50,11 @@ parser.add_argument('--rotate', default=False, action='store_true',
 parser.add_argument('--nosmooth', default=False, action='store_true',
 					help='Prevent smoothing face detections over a short temporal window')
 
+parser.add_argument('--preset', type=str, default='veryfast',
+					help='libx264 preset used to encode the output video')
+parser.add_argument('--crf', type=int, default=23,
+					help='libx264 constant rate factor (lower is better quality, 18-28 is sane)')
+
 args = parser.parse_args()
 args.img_size = 96
 
@@ -88,8 +93,11 @@ def face_detect(images):
 	pady1, pady2, padx1, padx2 = args.pads
 	for rect, image in zip(predictions, images):
 		if rect is None:
-			cv2.imwrite('temp/faulty_frame.jpg', image) # check this frame where the face was not detected.
-			raise ValueError('Face not detected! Ensure the video contains a face in all the frames.')
+			# Outside the scratch directory, which is removed with the error
+			fd, faulty_frame = tempfile.mkstemp(prefix='wav2lip_faulty_', suffix='.jpg')
+			os.close(fd)
+			cv2.imwrite(faulty_frame, image) # check this frame where the face was not detected.
+			raise ValueError('Face not detected! Ensure the video contains a face in all the frames. See {}'.format(faulty_frame))
 
 		y1 = max(0, rect[1] - pady1)
 		y2 = min(image.shape[0], rect[3] + pady2)
@@ -179,6 +187,13 @@ def load_model(path):
 	return model.eval()
 
 def main():
+	# Per-run scratch directory so concurrent runs never share temp files;
+	# it is removed even when the run fails
+	with tempfile.TemporaryDirectory(prefix='wav2lip_') as scratch_dir:
+		args.scratch_dir = scratch_dir
+		run()
+
+def run():
 	if not os.path.isfile(args.face):
 		raise ValueError('--face argument must be a valid path to video/image file')
 
@@ -216,10 +231,9 @@ def main():
 
 	if not args.audio.endswith('.wav'):
 		print('Extracting raw audio...')
-		command = 'ffmpeg -y -i {} -strict -2 {}'.format(args.audio, 'temp/temp.wav')
-
-		subprocess.call(command, shell=True)
-		args.audio = 'temp/temp.wav'
+		temp_wav = path.join(args.scratch_dir, 'temp.wav')
+		subprocess.call(['ffmpeg', '-y', '-i', args.audio, '-strict', '-2', temp_wav])
+		args.audio = temp_wav
 
 	wav = audio.load_wav(args.audio, 16000)
 	mel = audio.melspectrogram(wav)
@@ -253,8 +267,8 @@ def main():
 			print ("Model loaded")
 
 			frame_h, frame_w = full_frames[0].shape[:-1]
-			out = cv2.VideoWriter('temp/result.avi', 
-									cv2.VideoWriter_fourcc(*'DIVX'), fps, (frame_w, frame_h))
+			out = FFmpegWriter(args.outfile, (frame_w, frame_h), fps, audio_path=args.audio,
+								preset=args.preset, crf=args.crf)
 
 		img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
 		mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
@@ -271,10 +285,7 @@ def main():
 			f[y1:y2, x1:x2] = p
 			out.write(f)
 
-	out.release()
-
-	command = 'ffmpeg -y -i {} -i {} -strict -2 -q:v 1 {}'.format(args.audio, 'temp/result.avi', args.outfile)
-	subprocess.call(command, shell=platform.system() != 'Windows')
+	out.close()
 
 if __name__ == '__main__':
 	main()
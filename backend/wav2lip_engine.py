@@ -0,0 +1,357 @@
+"""
+Resident Wav2Lip inference engine.
+
+Loads the Wav2Lip checkpoint and the S3FD face detector once and keeps them in
+memory, so every /generate-video call only pays for the lip-sync itself instead
+of spawning a fresh `inference.py` process that re-imports torch and re-loads
+all the weights.
+"""
+import hashlib
+import os
+import sys
+import subprocess
+
+import cv2
+import numpy as np
+
+# Get the directory where this script is located
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Find Wav2Lip directory (case insensitive)
+if os.path.exists(os.path.join(script_dir, 'wav2lip')):
+    wav2lip_dir = os.path.join(script_dir, 'wav2lip')
+elif os.path.exists(os.path.join(script_dir, 'Wav2Lip')):
+    wav2lip_dir = os.path.join(script_dir, 'Wav2Lip')
+else:
+    raise FileNotFoundError("Wav2Lip directory not found")
+
+# The Wav2Lip sources import their siblings as top-level modules
+if wav2lip_dir not in sys.path:
+    sys.path.insert(0, wav2lip_dir)
+
+import torch
+import audio
+import face_detection
+from models import Wav2Lip
+from ffmpeg_writer import FFmpegWriter
+
+DEFAULT_CHECKPOINT = os.path.join(wav2lip_dir, 'checkpoints', 'wav2lip_gan.pth')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+IMG_SIZE = 96
+MEL_STEP_SIZE = 16
+SAMPLE_RATE = 16000
+
+# Size of the first model batch when streaming; later batches double up to
+# wav2lip_batch_size so the first fragment is encoded quickly
+STREAM_FIRST_BATCH_SIZE = 16
+
+
+def load_wav(audio_path):
+    """Decode any audio file to a mono 16 kHz float waveform"""
+    if audio_path.endswith('.wav'):
+        return audio.load_wav(audio_path, SAMPLE_RATE)
+
+    # Let ffmpeg decode and resample straight into memory instead of
+    # writing an intermediate temp/temp.wav
+    command = [
+        'ffmpeg', '-loglevel', 'error', '-i', audio_path,
+        '-f', 'f32le', '-ac', '1', '-ar', str(SAMPLE_RATE), '-',
+    ]
+    result = subprocess.run(command, stdout=subprocess.PIPE, check=True)
+    return np.frombuffer(result.stdout, dtype=np.float32)
+
+
+def file_hash(path):
+    """sha256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_mel_chunks(wav, fps):
+    """Split the mel spectrogram of `wav` into one window per video frame"""
+    mel = audio.melspectrogram(wav)
+    if np.isnan(mel.reshape(-1)).sum() > 0:
+        raise ValueError('Mel contains nan! Using a TTS voice? Add a small epsilon noise to the wav file and try again')
+
+    mel_chunks = []
+    mel_idx_multiplier = 80. / fps
+    i = 0
+    while 1:
+        start_idx = int(i * mel_idx_multiplier)
+        if start_idx + MEL_STEP_SIZE > len(mel[0]):
+            mel_chunks.append(mel[:, len(mel[0]) - MEL_STEP_SIZE:])
+            break
+        mel_chunks.append(mel[:, start_idx: start_idx + MEL_STEP_SIZE])
+        i += 1
+    return mel_chunks
+
+
+def get_smoothened_boxes(boxes, T):
+    for i in range(len(boxes)):
+        if i + T > len(boxes):
+            window = boxes[len(boxes) - T:]
+        else:
+            window = boxes[i: i + T]
+        boxes[i] = np.mean(window, axis=0)
+    return boxes
+
+
+class PreparedAvatar:
+    """A still avatar with its face already detected, cropped and turned into model input"""
+
+    def __init__(self, key, frame, coords, face, face_tensor):
+        self.key = key
+        self.frame = frame              # base frame the mouth is composited into
+        self.coords = coords            # (y1, y2, x1, x2) face crop box in `frame`
+        self.face = face                # 96x96 resized face crop
+        self.face_tensor = face_tensor  # (1, 6, 96, 96) masked + unmasked model input
+
+
+class Wav2LipEngine:
+    """Holds a loaded Wav2Lip model and face detector for repeated generation"""
+
+    def __init__(self, checkpoint_path=DEFAULT_CHECKPOINT, device=None,
+                 pads=(0, 5, 0, 0), nosmooth=True, fps=25., avatar_width=256,
+                 face_det_batch_size=16, wav2lip_batch_size=128,
+                 preset='veryfast', crf=23):
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        self.checkpoint_path = checkpoint_path
+        self.pads = pads
+        self.nosmooth = nosmooth
+        self.fps = fps
+        self.avatar_width = avatar_width
+        self.face_det_batch_size = face_det_batch_size
+        self.wav2lip_batch_size = wav2lip_batch_size
+        self.preset = preset
+        self.crf = crf
+
+        print(f"Using {self.device} for inference.")
+        self.model = self._load_model(checkpoint_path)
+        self.checkpoint_hash = file_hash(checkpoint_path)
+        self.detector = face_detection.FaceAlignment(
+            face_detection.LandmarksType._2D, flip_input=False, device=self.device
+        )
+        print("Wav2Lip engine ready")
+
+    def render_params(self):
+        """Everything besides the audio and the avatar that determines a rendered video"""
+        return {
+            'checkpoint': self.checkpoint_hash,
+            'pads': list(self.pads),
+            'nosmooth': self.nosmooth,
+            'fps': self.fps,
+            'avatar_width': self.avatar_width,
+            'preset': self.preset,
+            'crf': self.crf,
+        }
+
+    def _load_model(self, path):
+        print(f"Load checkpoint from: {path}")
+        if self.device == 'cuda':
+            checkpoint = torch.load(path)
+        else:
+            checkpoint = torch.load(path, map_location=lambda storage, loc: storage)
+
+        model = Wav2Lip()
+        state_dict = {k.replace('module.', ''): v for k, v in checkpoint["state_dict"].items()}
+        model.load_state_dict(state_dict)
+        return model.to(self.device).eval()
+
+    def resize_avatar(self, image):
+        """Downscale a still avatar to the working width, keeping its aspect ratio"""
+        height, width = image.shape[:2]
+        new_height = int(self.avatar_width / (width / height))
+        return cv2.resize(image, (self.avatar_width, new_height))
+
+    def read_avatar(self, avatar_path):
+        """Return the frames and fps of an avatar video, or a prepared still avatar"""
+        if not os.path.isfile(avatar_path):
+            raise ValueError(f"Avatar must be a valid path to a video/image file: {avatar_path}")
+
+        if avatar_path.lower().endswith(IMAGE_EXTENSIONS):
+            return self.prepare_avatar(cv2.imread(avatar_path))
+
+        video_stream = cv2.VideoCapture(avatar_path)
+        fps = video_stream.get(cv2.CAP_PROP_FPS)
+        frames = []
+        while 1:
+            still_reading, frame = video_stream.read()
+            if not still_reading:
+                video_stream.release()
+                break
+            frames.append(frame)
+        return frames, fps
+
+    def prepare_avatar(self, image, key=None):
+        """Run face detection once on a still avatar and keep everything the model needs"""
+        frame = self.resize_avatar(image)
+        face, coords = self.face_detect([frame])[0]
+        face = cv2.resize(face, (IMG_SIZE, IMG_SIZE))
+
+        face_input, _ = self._make_batch([face], [])
+        face_tensor = torch.FloatTensor(np.transpose(face_input, (0, 3, 1, 2))).to(self.device)
+        return PreparedAvatar(key, frame, coords, face, face_tensor)
+
+    def face_detect(self, images):
+        batch_size = self.face_det_batch_size
+
+        while 1:
+            predictions = []
+            try:
+                for i in range(0, len(images), batch_size):
+                    predictions.extend(self.detector.get_detections_for_batch(np.array(images[i:i + batch_size])))
+            except RuntimeError:
+                if batch_size == 1:
+                    raise RuntimeError('Image too big to run face detection on GPU')
+                batch_size //= 2
+                print(f"Recovering from OOM error; New batch size: {batch_size}")
+                continue
+            break
+
+        results = []
+        pady1, pady2, padx1, padx2 = self.pads
+        for rect, image in zip(predictions, images):
+            if rect is None:
+                raise ValueError('Face not detected! Ensure the video contains a face in all the frames.')
+
+            y1 = max(0, rect[1] - pady1)
+            y2 = min(image.shape[0], rect[3] + pady2)
+            x1 = max(0, rect[0] - padx1)
+            x2 = min(image.shape[1], rect[2] + padx2)
+            results.append([x1, y1, x2, y2])
+
+        boxes = np.array(results)
+        if not self.nosmooth:
+            boxes = get_smoothened_boxes(boxes, T=5)
+        return [[image[y1: y2, x1:x2], (y1, y2, x1, x2)] for image, (x1, y1, x2, y2) in zip(images, boxes)]
+
+    def _make_batch(self, img_batch, mel_batch):
+        img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
+
+        img_masked = img_batch.copy()
+        img_masked[:, IMG_SIZE // 2:] = 0
+
+        img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
+        if len(mel_batch) > 0:
+            mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
+        return img_batch, mel_batch
+
+    def _to_tensor(self, batch):
+        return torch.FloatTensor(np.transpose(batch, (0, 3, 1, 2))).to(self.device)
+
+    def datagen(self, frames, mels):
+        img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
+
+        face_det_results = self.face_detect(frames)
+
+        for i, m in enumerate(mels):
+            idx = i % len(frames)
+            face, coords = face_det_results[idx]
+
+            img_batch.append(cv2.resize(face, (IMG_SIZE, IMG_SIZE)))
+            mel_batch.append(m)
+            frame_batch.append(frames[idx].copy())
+            coords_batch.append(coords)
+
+            if len(img_batch) >= self.wav2lip_batch_size:
+                img_batch, mel_batch = self._make_batch(img_batch, mel_batch)
+                yield self._to_tensor(img_batch), self._to_tensor(mel_batch), frame_batch, coords_batch
+                img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
+
+        if len(img_batch) > 0:
+            img_batch, mel_batch = self._make_batch(img_batch, mel_batch)
+            yield self._to_tensor(img_batch), self._to_tensor(mel_batch), frame_batch, coords_batch
+
+    def static_datagen(self, avatar, mels, first_batch_size=None):
+        """Batches for a prepared still avatar: no detection, resizing or copying of the face
+
+        With `first_batch_size` the batches start small and double up to the
+        configured batch size, so the first frames are ready as soon as possible.
+        """
+        batch_size = first_batch_size or self.wav2lip_batch_size
+        i = 0
+        while i < len(mels):
+            mel_batch = np.asarray(mels[i:i + batch_size])
+            mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
+            i += len(mel_batch)
+            batch_size = min(batch_size * 2, self.wav2lip_batch_size)
+
+            img_batch = avatar.face_tensor.expand(len(mel_batch), -1, -1, -1)
+            frame_batch = [avatar.frame.copy() for _ in range(len(mel_batch))]
+            coords_batch = [avatar.coords] * len(mel_batch)
+            yield img_batch, self._to_tensor(mel_batch), frame_batch, coords_batch
+
+    def _predict(self, batches, write_frame):
+        """Run the model over `batches` and pass each composited frame to `write_frame`"""
+        for img_batch, mel_batch, frames, coords in batches:
+            with torch.no_grad():
+                pred = self.model(mel_batch, img_batch)
+
+            pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+            for p, f, c in zip(pred, frames, coords):
+                y1, y2, x1, x2 = c
+                f[y1:y2, x1:x2] = cv2.resize(p.astype(np.uint8), (x2 - x1, y2 - y1))
+                write_frame(f)
+            yield len(frames)
+
+    def generate(self, mux_audio_path, avatar, output_path, fragmented=False, progress=None,
+                 mel_audio_path=None):
+        """Lip-sync `avatar` to `mux_audio_path` and write the mp4 to `output_path`
+
+        The mels are computed from `mel_audio_path` when given (e.g. a ready
+        16 kHz decode of the same speech), while the video always carries
+        `mux_audio_path` itself.
+
+        `avatar` is either a PreparedAvatar or the path of an avatar image/video.
+        With `fragmented=True` the mp4 is written progressively, batch by batch,
+        so it can be served while the rest is still being generated.
+        `progress(stage, fraction)` is called as the face, render and mux
+        stages advance.
+        """
+        report = progress or (lambda stage, fraction: None)
+        mel_audio_path = mel_audio_path or mux_audio_path
+
+        report("face", 0.)
+        if not isinstance(avatar, PreparedAvatar):
+            avatar = self.read_avatar(avatar)
+
+        if isinstance(avatar, PreparedAvatar):
+            fps = self.fps
+            mel_chunks = get_mel_chunks(load_wav(mel_audio_path), fps)
+            frame_h, frame_w = avatar.frame.shape[:-1]
+            first_batch_size = STREAM_FIRST_BATCH_SIZE if fragmented else None
+            batches = self.static_datagen(avatar, mel_chunks, first_batch_size=first_batch_size)
+        else:
+            full_frames, fps = avatar
+            mel_chunks = get_mel_chunks(load_wav(mel_audio_path), fps)
+            full_frames = full_frames[:len(mel_chunks)]
+            frame_h, frame_w = full_frames[0].shape[:-1]
+            batches = self.datagen(full_frames, mel_chunks)
+        report("face", 1.)
+        print(f"Generating {len(mel_chunks)} frames")
+
+        # Frames go straight into a single ffmpeg process that also muxes the
+        # audio, producing the final H.264 mp4 in one pass
+        writer = FFmpegWriter(output_path, (frame_w, frame_h), fps, audio_path=mux_audio_path,
+                              fragmented=fragmented, preset=self.preset, crf=self.crf)
+        rendered = 0
+        report("render", 0.)
+        try:
+            for n in self._predict(batches, writer.write):
+                if fragmented:
+                    writer.flush()
+                rendered += n
+                report("render", rendered / len(mel_chunks))
+        except Exception:
+            writer.abort()
+            raise
+
+        report("mux", 0.)
+        writer.close()
+        report("mux", 1.)
+
+        return output_path
@@ -0,0 +1,64 @@
+# bm25.py
+
+import math
+import re
+from collections import Counter
+
+TOKEN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+STOPWORDS = frozenset(
+    """
+    a about after again all also am an and any are as at be because been before
+    being but by can could did do does doing don't for from had has have having
+    he her here hers him his how i i'm if in into is it it's its just me more
+    most my no not now of on once only or other our out over own so some such
+    than that the their them then there these they this those through to too
+    up very was we were what when where which while who why will with would
+    you your yours
+    """.split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercased content words of `text`."""
+    return [token for token in TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+
+class BM25:
+    """
+    Okapi BM25 keyword index over a fixed list of texts.
+    """
+
+    def __init__(self, texts: list[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.docs = [Counter(tokenize(text)) for text in texts]
+        self.lengths = [sum(doc.values()) for doc in self.docs]
+        self.avg_length = sum(self.lengths) / len(self.docs) if self.docs else 0.0
+
+        document_frequency = Counter()
+        for doc in self.docs:
+            document_frequency.update(doc.keys())
+        n = len(self.docs)
+        self.idf = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for term, df in document_frequency.items()
+        }
+
+    def scores(self, query: str) -> list[float]:
+        terms = [term for term in set(tokenize(query)) if term in self.idf]
+        scores = []
+        for doc, length in zip(self.docs, self.lengths):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / (self.avg_length or 1.0))
+            for term in terms:
+                tf = doc.get(term, 0)
+                if tf:
+                    score += self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            scores.append(score)
+        return scores
+
+    def top(self, query: str, n: int) -> list[tuple[int, float]]:
+        """(position, score) of the `n` best matching texts with a positive score."""
+        ranked = sorted(enumerate(self.scores(query)), key=lambda item: item[1], reverse=True)
+        return [(i, score) for i, score in ranked[:n] if score > 0]
@@ -36,7 +36,53 @@ Use tactics to trap the other party into making concessions or revealing their t
 Your goal is to leveerage the right negotiation techniques to achieve the best outcome for your side."""
 
 
+# ─── PROMPT SIZE ───────────────────────────────────────────────────────────────
+# persona.txt is sent whole unless PERSONA_TOKEN_BUDGET (0 = no limit) condenses
+# it to whole sections, and the oldest history is dropped so every prompt
+# leaves REPLY_TOKEN_RESERVE tokens of the model's context for the reply.
+PERSONA_TOKEN_BUDGET = int(os.getenv("PERSONA_TOKEN_BUDGET", "0"))
+MODEL_CONTEXT_TOKENS = int(os.getenv("MODEL_CONTEXT_TOKENS", "8192"))
+REPLY_TOKEN_RESERVE = int(os.getenv("REPLY_TOKEN_RESERVE", "1000"))
+
+
 ENABLE_SPEECH = True  # Set to False if you want text-only responses
 
 # ─── WHISPER MODEL ─────────────────────────────────────────────────────────────
 WHISPER_MODEL = "whisper-1"  # or another OpenAI audio model
+
+# ─── ROLE ROUTING ──────────────────────────────────────────────────────────────
+# "local":  keyword router, GPT fallback only when it is unsure (default)
+# "llm":    classify every turn with GPT
+# "prompt": no separate routing step, the reply prompt carries both roles
+ROUTER_MODE = os.getenv("ROUTER_MODE", "local")
+ROUTER_MIN_CONFIDENCE = float(os.getenv("ROUTER_MIN_CONFIDENCE", "0.5"))
+
+ROUTED_SYSTEM_PROMPT = f"""You are Kirk Kinnell. First decide from the user's latest message which of these two roles fits, then answer in that role only, without mentioning the choice.
+
+If the user asks for training, tips, feedback or explanations, act as the coach:
+{COACH_SYSTEM_PROMPT}
+
+If the user asks you to negotiate for them, to simulate a negotiation or to help them in a live negotiation, act as the negotiator:
+{NEGOTIATOR_SYSTEM_PROMPT}"""
+
+# ─── EMBEDDING CACHE ───────────────────────────────────────────────────────────
+# Query/document vectors kept in memory (LRU) and, unless the path is empty,
+# in a sqlite file that survives restarts
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+EMBEDDING_CACHE_DB = os.getenv(
+    "EMBEDDING_CACHE_DB",
+    os.path.join(os.path.dirname(__file__), "index_store", "embeddings.sqlite"),
+)
+
+# ─── EMBEDDING BACKEND ─────────────────────────────────────────────────────────
+# "openai": OpenAI embeddings API
+# "local":  sentence-transformers model on the CPU, no network needed
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai")
+OPENAI_EMBEDDING_MODEL = "text-embedding-ada-002"
+LOCAL_EMBEDDING_MODEL = os.getenv(
+    "LOCAL_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2"
+)
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", "32"))
+
+# Set to 0 to index raw chunks without the GPT cleaning pass (e.g. offline)
+CLEAN_CHUNKS = os.getenv("RAG_CLEAN_CHUNKS", "1") != "0"
@@ -0,0 +1,111 @@
+# intent_router.py
+
+import re
+from functools import lru_cache
+
+# Cue patterns with their weight towards each role. Live negotiation cues are
+# specific (role-play requests, concrete offers, what to say next), so anything
+# that does not match clearly is left to the GPT classifier. Topic words such
+# as salary, rent or price say what the negotiation is about, not which role
+# is wanted, so they are not cues.
+ROLE_CUES = {
+    "coaching": [
+        (r"\bhow (do|can|should|would) (i|you|we|one)\b", 2.0),
+        (r"\b(what|why) (is|are|does|do)\b", 1.0),
+        (r"\b(explain|teach|learn|understand|improve|practi[cs]e)\b", 2.0),
+        (r"\b(tips?|advice|feedback|lessons?|mistakes?)\b", 2.0),
+        (r"\b(prepare|preparing|get ready)\b", 2.0),
+        (r"\b(techniques?|tactics?|strateg(y|ies)|principles?|skills?)\b", 1.5),
+        (r"\b(story|stories|anecdotes?|experience|career)\b", 1.5),
+        (r"\btell me about\b", 1.5),
+        (r"\bbest way\b", 1.0),
+    ],
+    "negotiator": [
+        (r"\brole[- ]?play\b", 3.0),
+        (r"\b(simulate|simulation|pretend)\b", 3.0),
+        (r"\b(act|play) as\b", 2.5),
+        (r"\byou are (the|my|a)\b", 2.0),
+        (r"\b(for me|on my behalf)\b", 2.0),
+        (r"\b(my|your|their|final|counter) ?offer\b", 2.0),
+        (r"\bi('ll| will) (give|pay|offer|take)\b", 2.0),
+        (r"[$€£]\s?\d", 2.0),
+        (r"\b(right now|they just|he just|she just)\b", 1.5),
+        (r"\bwhat (should|do) i (say|reply|answer)\b", 2.0),
+        (r"\b(the other (side|party)|my (boss|landlord|client|supplier))\b", 1.0),
+    ],
+}
+
+# Labelled messages the router must not send to the wrong role; checked by
+# `python -m whisper.intent_router` after changing the cues
+EXAMPLES = [
+    ("How do I ask for a raise?", "coaching"),
+    ("Can you help me prepare for a salary negotiation?", "coaching"),
+    ("What are the best tactics for negotiating my rent?", "coaching"),
+    ("Give me some tips for negotiating a discount", "coaching"),
+    ("What mistakes do people make when negotiating a contract?", "coaching"),
+    ("How should I handle a difficult client?", "coaching"),
+    ("Tell me about the Glasgow siege", "coaching"),
+    ("Why does anchoring work in a price negotiation?", "coaching"),
+    ("Let's role-play: you are my landlord and I want lower rent", "negotiator"),
+    ("Pretend you are the car dealer. I'll offer $15,000", "negotiator"),
+    ("Negotiate my salary for me", "negotiator"),
+    ("My boss just offered me a 5% raise, what should I say?", "negotiator"),
+    ("Act as the supplier, their final offer is £40 per unit", "negotiator"),
+    ("Simulate a negotiation with a hostage taker", "negotiator"),
+]
+
+_COMPILED_CUES = {
+    role: [(re.compile(pattern), weight) for pattern, weight in cues]
+    for role, cues in ROLE_CUES.items()
+}
+
+
+def normalize(text: str) -> str:
+    """Lowercase and collapse whitespace so trivially different inputs share a cache entry."""
+    return " ".join(text.lower().split())
+
+
+@lru_cache(maxsize=1024)
+def _score(normalized: str) -> tuple[str, float]:
+    scores = {
+        role: sum(weight for pattern, weight in cues if pattern.search(normalized))
+        for role, cues in _COMPILED_CUES.items()
+    }
+    (best, top), (_, other) = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    # Margin between the two roles, damped so a single weak cue is not enough
+    confidence = (top - other) / (top + other + 1.0)
+    return best, confidence
+
+
+def route(user_input: str) -> tuple[str, float]:
+    """
+    Classify the user's intent locally: returns ("coaching" | "negotiator", confidence in [0, 1)).
+    """
+    return _score(normalize(user_input))
+
+
+def check(min_confidence: float = 0.5) -> list[str]:
+    """
+    Run the router over EXAMPLES. Returns one line per message that is routed
+    to the wrong role with enough confidence to skip GPT (a regression), and
+    prints the examples that are merely left to GPT.
+    """
+    failures = []
+    for text, expected in EXAMPLES:
+        role, confidence = route(text)
+        if confidence < min_confidence:
+            print(f"unsure ({role}, {confidence:.2f}): {text}")
+        elif role != expected:
+            failures.append(f"{text!r}: {role} ({confidence:.2f}), expected {expected}")
+    return failures
+
+
+if __name__ == "__main__":
+    # Regression check: python -m whisper.intent_router
+    import sys
+    from whisper.config import ROUTER_MIN_CONFIDENCE
+
+    failures = check(ROUTER_MIN_CONFIDENCE)
+    for failure in failures:
+        print(f"misrouted {failure}")
+    sys.exit(1 if failures else 0)
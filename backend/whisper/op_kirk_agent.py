@@ -1,9 +1,25 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+import asyncio
 import os
+import threading
+from collections import OrderedDict
+from typing import Optional
 from dotenv import load_dotenv
+import tiktoken
 
 # from config import COACH_SYSTEM_PROMPT, NEGOTIATOR_SYSTEM_PROMPT
-from whisper.config import COACH_SYSTEM_PROMPT, NEGOTIATOR_SYSTEM_PROMPT
+from whisper.config import (
+    COACH_SYSTEM_PROMPT,
+    NEGOTIATOR_SYSTEM_PROMPT,
+    ROUTED_SYSTEM_PROMPT,
+    PERSONA_TOKEN_BUDGET,
+    MODEL_CONTEXT_TOKENS,
+    REPLY_TOKEN_RESERVE,
+    ROUTER_MODE,
+    ROUTER_MIN_CONFIDENCE,
+)
+from whisper import intent_router
+from whisper.rag_engine import rerank_chunks
 
 # Load keys
 load_dotenv()
@@ -11,13 +27,16 @@ load_dotenv()
 client = OpenAI(
     api_key=os.getenv("OPENAI_API_KEY"),
 )
+# Async client for callers that fan several requests out concurrently
+async_client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+)
 
+NO_BOOK_CONTENT = "No relevant content from the book."
 
-def classify_role(user_input: str) -> str:
-    """
-    Use GPT to classify the user's intent on this turn: coaching vs negotiator.
-    """
-    prompt = f"""
+
+def _classify_prompt(user_input: str) -> str:
+    return f"""
 You are an intent classification assistant.
 
 Your job is to determine whether the user is:
@@ -32,105 +51,337 @@ Respond with exactly one word:
 - "coaching" if they are asking for training, or explanation
 - "negotiator" if they are asking you to negotiate for them, simulate a negotiation or help them in a live negotiation
 """
+
+
+def classify_role(user_input: str) -> str:
+    """
+    Use GPT to classify the user's intent on this turn: coaching vs negotiator.
+    """
     response = client.chat.completions.create(
         model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
+        messages=[{"role": "user", "content": _classify_prompt(user_input)}],
         temperature=0,
     )
     return response.choices[0].message.content.strip().lower()
 
 
-def get_kirk_response(user_input: str, chat_history: list[dict]) -> str:
+async def aclassify_role(user_input: str) -> str:
+    """
+    Async variant of classify_role.
+    """
+    response = await async_client.chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=[{"role": "user", "content": _classify_prompt(user_input)}],
+        temperature=0,
+    )
+    return response.choices[0].message.content.strip().lower()
+
+
+# Normalised input -> role returned by the GPT classifier
+_llm_roles = OrderedDict()
+MAX_CACHED_ROLES = 1024
+
+
+def _local_role(user_input: str) -> tuple[Optional[str], Optional[str]]:
+    """
+    Route without a network call where possible.
+    Returns (role, None) when decided, or (None, cache key) when GPT has to classify.
+    """
+    if ROUTER_MODE == "prompt":
+        return None, None
+
+    key = intent_router.normalize(user_input)
+    if ROUTER_MODE != "llm":
+        role, confidence = intent_router.route(user_input)
+        if confidence >= ROUTER_MIN_CONFIDENCE:
+            return role, None
+
+    if key in _llm_roles:
+        _llm_roles.move_to_end(key)
+        return _llm_roles[key], None
+    return None, key
+
+
+def _remember_role(key: str, role: str) -> str:
+    _llm_roles[key] = role
+    while len(_llm_roles) > MAX_CACHED_ROLES:
+        _llm_roles.popitem(last=False)
+    return role
+
+
+def choose_role(user_input: str) -> Optional[str]:
+    """
+    Role for this turn according to ROUTER_MODE; None lets the reply prompt decide.
     """
-    Classify role, build prompt with persona, and return Kirk's assistant reply.
+    role, key = _local_role(user_input)
+    if key is None:
+        return role
+    return _remember_role(key, classify_role(user_input))
+
+
+async def achoose_role(user_input: str) -> Optional[str]:
     """
-    role = classify_role(user_input)
-    print(f"[Router → Role selected: {role}]")
+    Async variant of choose_role.
+    """
+    role, key = _local_role(user_input)
+    if key is None:
+        return role
+    return _remember_role(key, await aclassify_role(user_input))
+
+
+# Persona next to this module, not in the working directory
+PERSONA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "persona.txt")
+
+# System messages per role (None = routed in the prompt), rebuilt when persona.txt changes
+_system_messages = {}
+_persona_mtime = None
+_persona_lock = threading.Lock()
+_encoding = None
+
+
+def _condense_persona(persona_text: str) -> str:
+    """
+    Whole sections of the persona, in order, up to PERSONA_TOKEN_BUDGET tokens.
+    Sections start at a **heading** line; `***` separators are dropped.
+    Without a budget the persona is kept as it is.
+    """
+    if PERSONA_TOKEN_BUDGET <= 0:
+        return persona_text
+
+    sections, current = [], []
+    for line in persona_text.splitlines():
+        if line.startswith("**") and current:
+            sections.append("\n".join(current).strip())
+            current = []
+        current.append(line)
+    sections.append("\n".join(current).strip())
+    sections = [section for section in sections if section.strip("* \n")]
 
-    # Load persona
+    kept, used = [], 0
+    for section in sections:
+        tokens = _count_tokens(section)
+        if used + tokens > PERSONA_TOKEN_BUDGET:
+            break
+        kept.append(section)
+        used += tokens
+    print(f"Persona: {len(kept)} of {len(sections)} sections ({used} tokens)")
+    return "\n\n".join(kept)
+
+
+def _load_system_messages() -> dict:
+    """
+    Return the prebuilt persona + role system messages, reloading persona.txt
+    only when its modification time changed.
+    """
+    global _system_messages, _persona_mtime
     try:
-        with open("persona.txt", "r", encoding="utf-8") as f:
-            persona_text = f.read().strip()
+        mtime = os.stat(PERSONA_PATH).st_mtime
     except FileNotFoundError:
+        mtime = None
+
+    if mtime == _persona_mtime and _system_messages:
+        return _system_messages
+
+    with _persona_lock:
+        if mtime == _persona_mtime and _system_messages:
+            return _system_messages
+
         persona_text = ""
+        if mtime is not None:
+            with open(PERSONA_PATH, "r", encoding="utf-8") as f:
+                persona_text = _condense_persona(f.read().strip())
+
+        prompts = {
+            None: ROUTED_SYSTEM_PROMPT,
+            "coaching": COACH_SYSTEM_PROMPT,
+            "negotiator": NEGOTIATOR_SYSTEM_PROMPT,
+        }
+        _system_messages = {
+            role: {
+                "role": "system",
+                "content": f"{persona_text}\n\n{prompt}" if persona_text else prompt,
+            }
+            for role, prompt in prompts.items()
+        }
+        _persona_mtime = mtime
+    return _system_messages
+
+
+def _count_tokens(text: str) -> int:
+    global _encoding
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.encoding_for_model("gpt-4")
+        except Exception as e:
+            # e.g. the encoding cannot be downloaded; fall back to an estimate
+            print(f"Error loading tiktoken encoding: {str(e)}")
+            _encoding = False
+    if _encoding is False:
+        return len(text) // 4 + 1
+    return len(_encoding.encode(text))
+
+
+def system_message_tokens() -> int:
+    """
+    Tokens of the largest persona + role system message sent in front of the
+    history, for callers that budget the whole prompt.
+    """
+    return max(_count_tokens(m["content"]) + 4 for m in _load_system_messages().values())
+
 
-    base_prompt = (
-        COACH_SYSTEM_PROMPT if role == "coaching" else NEGOTIATOR_SYSTEM_PROMPT
+def _reply_messages(
+    role: Optional[str], user_input: str, chat_history: list[dict]
+) -> list[dict]:
+    """
+    Build the persona + role system prompt followed by the conversation.
+    Without a role, the prompt describes both and the model picks one.
+    """
+    print(f"[Router → Role selected: {role or 'in prompt'}]")
+
+    system_messages = _load_system_messages()
+    # Anything other than coaching (or no role) gets the negotiator prompt
+    system_message = system_messages.get(role, system_messages["negotiator"])
+
+    return _fit_context(
+        [system_message] + chat_history + [{"role": "user", "content": user_input}]
     )
-    full_prompt = f"{persona_text}\n\n{base_prompt}" if persona_text else base_prompt
 
-    messages = [{"role": "system", "content": full_prompt}]
-    messages += chat_history + [{"role": "user", "content": user_input}]
 
+def _fit_context(messages: list[dict]) -> list[dict]:
+    """
+    Drop the oldest conversation messages until the prompt leaves
+    REPLY_TOKEN_RESERVE tokens of the model's context for the reply.
+    System messages and the current user message are always kept.
+    """
+    budget = MODEL_CONTEXT_TOKENS - REPLY_TOKEN_RESERVE
+    sizes = [_count_tokens(m["content"]) + 4 for m in messages]
+    used = sum(sizes)
+    messages = list(messages)
+    while used > budget:
+        oldest = next(
+            (i for i, m in enumerate(messages[:-1]) if m["role"] != "system"), None
+        )
+        if oldest is None:
+            break
+        used -= sizes.pop(oldest)
+        del messages[oldest]
+    return messages
+
+
+def get_kirk_response(user_input: str, chat_history: list[dict]) -> str:
+    """
+    Route the turn to a role, build prompt with persona, and return Kirk's assistant reply.
+    """
+    role = choose_role(user_input)
     response = client.chat.completions.create(
         model="gpt-4",
-        messages=messages,
+        messages=_reply_messages(role, user_input, chat_history),
         temperature=0.7,
     )
     return response.choices[0].message.content.strip()
 
 
-def summarize_reply(reply: str) -> str:
+async def aget_kirk_response(user_input: str, chat_history: list[dict]) -> str:
     """
-    Bullet-point summary for display. Outputs 2–5 key points.
+    Async variant of get_kirk_response.
+    """
+    role = await achoose_role(user_input)
+    response = await async_client.chat.completions.create(
+        model="gpt-4",
+        messages=_reply_messages(role, user_input, chat_history),
+        temperature=0.7,
+    )
+    return response.choices[0].message.content.strip()
+
+
+async def astream_kirk_response(user_input: str, chat_history: list[dict]):
+    """
+    Streaming variant of get_kirk_response: yields the reply token by token.
     """
-    prompt = f"""
+    role = await achoose_role(user_input)
+    stream = await async_client.chat.completions.create(
+        model="gpt-4",
+        messages=_reply_messages(role, user_input, chat_history),
+        temperature=0.7,
+        stream=True,
+    )
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        token = chunk.choices[0].delta.content
+        if token:
+            yield token
+
+
+def _summary_prompt(reply: str) -> str:
+    return f"""
 Summarize the assistant's reply into a bullet list of the key ideas.
 Use 2 to 5 bullet points. Be concise.
 
 Reply:
 {reply}
 """
+
+
+def summarize_reply(reply: str) -> str:
+    """
+    Bullet-point summary for display. Outputs 2–5 key points.
+    """
     response = client.chat.completions.create(
         model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
+        messages=[{"role": "user", "content": _summary_prompt(reply)}],
         temperature=0.5,
     )
     return response.choices[0].message.content.strip()
 
 
+async def asummarize_reply(reply: str) -> str:
+    """
+    Async variant of summarize_reply.
+    """
+    response = await async_client.chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=[{"role": "user", "content": _summary_prompt(reply)}],
+        temperature=0.5,
+    )
+    return response.choices[0].message.content.strip()
+
+
+def format_book_insight(chunk: dict) -> str:
+    """
+    Cite a chunk as Kirk. PDF pages are numbered from 0 in the index;
+    transcripts have no pages, so their citation leaves the page out.
+    """
+    page = chunk.get("page")
+    title = chunk.get("title", "my book")
+    if isinstance(page, int):
+        return f"Here's what I say in {title} on page {page + 1}: {chunk['text']}"
+    return f"Here's what I say in {title}: {chunk['text']}"
+
+
 def select_best_rag_chunk(
     rag_chunks: list[dict], kirk_reply: str, user_query: str
 ) -> str:
     """
-    From top-3 RAG chunks, select the most relevant one based on Kirk's reply and user query.
+    From the retrieved RAG chunks, select the most relevant one based on Kirk's reply and user query.
     If none are clearly helpful, return a fallback message.
     """
     if not rag_chunks or not kirk_reply:
-        return "No relevant content from the book."
+        return NO_BOOK_CONTENT
 
-    numbered_chunks = "\n\n".join(
-        f"{i + 1}. Page {chunk['page']}:\n{chunk['text']}"
-        for i, chunk in enumerate(rag_chunks)
-    )
+    best = rerank_chunks(rag_chunks, kirk_reply, user_query)
+    if best is None:
+        return NO_BOOK_CONTENT
+    return format_book_insight(best)
 
-    prompt = f"""
-You are helping match Kirk's reply with content from his book.
-Here is the user query:
-"{user_query}"
 
-Here are three short excerpts from his book:
-
-{numbered_chunks}
-
-Instructions:
-- Decide whether any of these excerpts are relevant to the user query.
-- If none are clearly helpful AND related, respond with exactly:
-No relevant content from the book.
-- Otherwise, if one of the excerpts contains several words or ideas Kirk expressed in his reply, choose the **most relevant** one if it clearly supports or explains Kirk's reply.
-
-If one is relevant, return it in the format:
-Here's what I say in my book on page X: ... (followed by the cleaned excerpt)
-"""
-
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0,
+async def aselect_best_rag_chunk(
+    rag_chunks: list[dict], kirk_reply: str, user_query: str
+) -> str:
+    """
+    Async variant of select_best_rag_chunk.
+    """
+    # Reranking may embed the reply, which blocks
+    return await asyncio.to_thread(
+        select_best_rag_chunk, rag_chunks, kirk_reply, user_query
     )
-
-    output = response.choices[0].message.content.strip()
-
-    if "no relevant content" in output.lower():
-        return "No relevant content from the book."
-    return output
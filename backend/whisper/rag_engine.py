@@ -1,85 +1,627 @@
 # rag_engine.py
 
-from langchain_community.document_loaders import PyPDFLoader
+from langchain_community.document_loaders import PyPDFLoader, TextLoader
 from langchain_community.embeddings import OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain.text_splitter import CharacterTextSplitter
 
 # from config import OPENAI_API_KEY
-from whisper.config import OPENAI_API_KEY
+from whisper.config import (
+    OPENAI_API_KEY,
+    EMBEDDING_CACHE_SIZE,
+    EMBEDDING_CACHE_DB,
+    EMBEDDING_BACKEND,
+    OPENAI_EMBEDDING_MODEL,
+    LOCAL_EMBEDDING_MODEL,
+    LOCAL_EMBEDDING_BATCH_SIZE,
+    CLEAN_CHUNKS,
+)
+from whisper.embedding_cache import CachedEmbeddings
+from whisper.bm25 import BM25, tokenize
 
 import openai
 import os
 
 openai.api_key = OPENAI_API_KEY
-os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
-import os
+if OPENAI_API_KEY:
+    os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
+import hashlib
+import json
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
+import numpy as np
+
+from openai import OpenAI
+
+BOOK_PATH = os.path.join(os.path.dirname(__file__), "Kirkbook.pdf")
+BOOK_TITLE = "my book"
+INDEX_STORE_DIR = os.path.join(os.path.dirname(__file__), "index_store")
+# Uploaded library documents
+DOCUMENTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "documents")
+TEXT_EXTENSIONS = (".txt", ".md")
+
+CHUNK_SIZE = 800
+CHUNK_OVERLAP = 100
+EMBEDDING_MODEL = (
+    LOCAL_EMBEDDING_MODEL if EMBEDDING_BACKEND == "local" else OPENAI_EMBEDDING_MODEL
+)
+CLEANING_MODEL = "gpt-3.5-turbo" if CLEAN_CHUNKS else None
+CLEANING_WORKERS = 8
+# Bump when the stored chunk metadata changes
+INDEX_FORMAT = 2
+
+CLEANING_PROMPT = """
+Here is a noisy or partial paragraph from a negotiation manual:
+
+{text}
+
+Your job is to:
+- Remove partial sentences at the beginning or end
+- Make the paragraph grammatically clean and self-contained
+- Keep it brief (3–5 sentences), no added commentary
+
+Return only the cleaned paragraph.
+"""
+
+# Generic reference queries that retrieval scores are compared against. Their
+# scores only depend on the index, so they are computed once and stored with it.
+BASELINE_QUERIES = {
+    "default": "this is how I negotiate",
+}
+
+# Candidates taken from each of FAISS and BM25 before fusion
+RETRIEVAL_CANDIDATES = 10
+# Reciprocal rank fusion constant
+RRF_K = 60
+# A chunk is only cited if it shares this many content words with Kirk's reply
+RERANK_MIN_SHARED_TERMS = 3
+
+
+_embeddings = None
+_embeddings_lock = threading.Lock()
+
+
+def make_embeddings():
+    """
+    The embedding model selected by EMBEDDING_BACKEND.
+    """
+    if EMBEDDING_BACKEND == "local":
+        # Imported here so the OpenAI backend does not pay for loading torch
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+
+        print(f"Loading local embedding model {LOCAL_EMBEDDING_MODEL}")
+        return HuggingFaceEmbeddings(
+            model_name=LOCAL_EMBEDDING_MODEL,
+            model_kwargs={"device": "cpu"},
+            encode_kwargs={
+                "batch_size": LOCAL_EMBEDDING_BATCH_SIZE,
+                "normalize_embeddings": True,
+            },
+        )
+    if EMBEDDING_BACKEND != "openai":
+        raise ValueError(f"Unknown EMBEDDING_BACKEND: {EMBEDDING_BACKEND}")
+    return OpenAIEmbeddings(model=OPENAI_EMBEDDING_MODEL)
+
+
+def get_embeddings() -> CachedEmbeddings:
+    """
+    The embedding model shared by index builds, retrieval and any other
+    consumer, behind the query/document vector cache.
+    """
+    global _embeddings
+    if _embeddings is None:
+        with _embeddings_lock:
+            if _embeddings is None:
+                if EMBEDDING_CACHE_DB:
+                    os.makedirs(os.path.dirname(EMBEDDING_CACHE_DB), exist_ok=True)
+                _embeddings = CachedEmbeddings(
+                    make_embeddings(),
+                    model_name=f"{EMBEDDING_BACKEND}:{EMBEDDING_MODEL}",
+                    max_entries=EMBEDDING_CACHE_SIZE,
+                    db_path=EMBEDDING_CACHE_DB or None,
+                )
+    return _embeddings
+
+
+def index_key(path: str) -> str:
+    """
+    Identify an index by everything that changes its contents: the PDF bytes,
+    the splitter parameters, the embedding backend and model and the chunk cleaning.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    params = (
+        f"{INDEX_FORMAT}:{CHUNK_SIZE}:{CHUNK_OVERLAP}:{EMBEDDING_BACKEND}:{EMBEDDING_MODEL}:"
+        f"{CLEANING_MODEL}:{CLEANING_PROMPT if CLEAN_CHUNKS else ''}"
+    )
+    digest.update(params.encode("utf-8"))
+    return digest.hexdigest()[:32]
 
-def load_and_index_pdf(path=None):
-    if path is None:
-        path = os.path.join(os.path.dirname(__file__), "Kirkbook.pdf")
 
-    loader = PyPDFLoader(path)
-    docs = loader.load()  # Each Document includes metadata["page"]
-    splitter = CharacterTextSplitter(chunk_size=800, chunk_overlap=100)
+def clean_chunk(client: OpenAI, text: str, attempts: int = 3) -> str:
+    """
+    Use GPT to turn a raw chunk into a clean, self-contained paragraph.
+    Retries with backoff and then raises, so a shard is never saved with
+    raw text standing in for cleaned text.
+    """
+    if not text.strip():
+        return text
+    for attempt in range(attempts):
+        try:
+            response = client.chat.completions.create(
+                model=CLEANING_MODEL,
+                messages=[{"role": "user", "content": CLEANING_PROMPT.format(text=text.strip())}],
+                temperature=0,
+            )
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            if attempt == attempts - 1:
+                raise
+            delay = random.uniform(1, 2) * 2 ** attempt
+            print(f"Error cleaning chunk ({str(e)}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def load_documents(path: str) -> list:
+    """
+    Load a PDF (one Document per page, with metadata["page"]) or a plain text transcript.
+    """
+    if path.lower().endswith(".pdf"):
+        return PyPDFLoader(path).load()
+    if os.path.splitext(path)[1].lower() in TEXT_EXTENSIONS:
+        return TextLoader(path, encoding="utf-8").load()
+    raise ValueError(f"Unsupported document type: {os.path.basename(path)}")
+
+
+def build_index(path: str, document_id: str):
+    docs = load_documents(path)
+    splitter = CharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
     splits = splitter.split_documents(docs)
+    if not splits:
+        raise ValueError(f"No text found in {os.path.basename(path)}")
+    for doc in splits:
+        doc.metadata["document_id"] = document_id
+
+    # Documents are static, so every chunk is cleaned here once instead of per query
+    if CLEAN_CHUNKS:
+        print(f"Cleaning {len(splits)} chunks")
+        client = OpenAI(api_key=OPENAI_API_KEY)
+        with ThreadPoolExecutor(max_workers=CLEANING_WORKERS) as executor:
+            cleaned = executor.map(
+                lambda doc: clean_chunk(client, doc.page_content), splits
+            )
+            for doc, cleaned_text in zip(splits, cleaned):
+                doc.metadata["cleaned"] = cleaned_text
+
+    return FAISS.from_documents(splits, get_embeddings())
+
+
+def calibrate_baselines(db, meta: dict) -> bool:
+    """
+    Score each baseline query against the index and record it in `meta`.
+    Only queries that are new or changed are searched. Returns True if `meta` changed.
+    """
+    baselines = meta.setdefault("baselines", {})
+    changed = False
+    for name, query in BASELINE_QUERIES.items():
+        if baselines.get(name, {}).get("query") == query:
+            continue
+        comparison = db.similarity_search_with_score(query, k=1)
+        score = float(comparison[0][1]) if comparison else 0.0
+        baselines[name] = {"query": query, "score": score}
+        changed = True
+    return changed
+
+
+def _read_json(path: str) -> dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_json(path: str, data: dict):
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def document_id(path: str) -> str:
+    """
+    Documents are identified by their contents, so re-adding one is a no-op.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def load_index(path=None):
+    """
+    Load the index shard for one document and its metadata from the index
+    store, building and saving it only when no shard matches the current
+    document, splitter and embedding model. Returns (db, meta).
+    """
+    if path is None:
+        path = BOOK_PATH
+
+    key = index_key(path)
+    index_dir = os.path.join(INDEX_STORE_DIR, key)
+    embeddings = get_embeddings()
+
+    if os.path.exists(os.path.join(index_dir, "index.faiss")):
+        print(f"Loading FAISS index {key[:12]} for {os.path.basename(path)}")
+        # The pickled docstore was written by this module, not taken from users
+        db = FAISS.load_local(
+            index_dir, embeddings, allow_dangerous_deserialization=True
+        )
+        return db, _read_json(os.path.join(index_dir, "meta.json"))
 
-    embeddings = OpenAIEmbeddings()
-    db = FAISS.from_documents(splits, embeddings)
+    print(f"Building FAISS index {key[:12]} for {os.path.basename(path)}")
+    db = build_index(path, document_id(path))
+    meta = {
+        "key": key,
+        "source": os.path.basename(path),
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "embedding_backend": EMBEDDING_BACKEND,
+        "embedding_model": EMBEDDING_MODEL,
+        "cleaning_model": CLEANING_MODEL,
+        "chunks": len(db.index_to_docstore_id),
+    }
+
+    # Write to a scratch directory first so a crash never leaves a partial index
+    os.makedirs(INDEX_STORE_DIR, exist_ok=True)
+    scratch_dir = tempfile.mkdtemp(prefix=f"{key}.tmp-", dir=INDEX_STORE_DIR)
+    db.save_local(scratch_dir)
+    _write_json(os.path.join(scratch_dir, "meta.json"), meta)
+    try:
+        os.replace(scratch_dir, index_dir)
+    except OSError:
+        # Another process stored the same index first
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    return db, meta
+
+
+def load_and_index_pdf(path=None):
+    db, _ = load_index(path)
     return db
 
 
-VECTOR_DB = load_and_index_pdf()
+# ─── DOCUMENT LIBRARY ─────────────────────────────────────────────────────────
+# Every document has its own index shard; the searchable index is the shards
+# merged together. Adding a document only embeds that document, and removing
+# one re-merges the remaining shards from disk without re-embedding anything.
+
+_vector_db = None
+_library = None
+_vector_db_lock = threading.RLock()
+# Held while the library is first loaded (or built), which can take minutes
+_load_lock = threading.Lock()
+# BM25 index over the chunks of _vector_db, in FAISS order
+_keyword_index = None
+_chunks = []
+
+
+def _library_path() -> str:
+    return os.path.join(INDEX_STORE_DIR, "library.json")
+
+
+def _document_path(entry: dict) -> str:
+    return os.path.join(os.path.dirname(__file__), entry["path"])
 
 
-def retrieve_chunks(query: str, k: int = 3, min_words: int = 30) -> list[dict]:
+def _relative_path(path: str) -> str:
+    """Paths under the whisper directory are stored relative to it."""
+    path = os.path.abspath(path)
+    base = os.path.dirname(os.path.abspath(__file__))
+    if os.path.commonpath([path, base]) == base:
+        return os.path.relpath(path, base)
+    return path
+
+
+def _load_library() -> dict:
+    library = _read_json(_library_path())
+    if "documents" not in library:
+        # First run: the library starts with Kirk's book
+        library = {
+            "documents": {
+                document_id(BOOK_PATH): {
+                    "title": BOOK_TITLE,
+                    "path": _relative_path(BOOK_PATH),
+                }
+            }
+        }
+    return library
+
+
+def _save_library():
+    os.makedirs(INDEX_STORE_DIR, exist_ok=True)
+    _write_json(_library_path(), _library)
+
+
+def _calibrate_library() -> bool:
     """
-    Retrieve top-k results only if they are more relevant to the query than to a generic phrase.
-    Returns cleaned text and page.
+    Baseline scores belong to the merged index, so they are recomputed
+    whenever the set of shards changes.
     """
-    baseline = "this is how I negotiate"
-    comparison = VECTOR_DB.similarity_search_with_score(baseline, k=1)
-    baseline_score = comparison[0][1] if comparison else 0.0
+    shards = sorted(entry.get("key", "") for entry in _library["documents"].values())
+    if _library.get("baseline_shards") != shards:
+        _library["baselines"] = {}
+        _library["baseline_shards"] = shards
+    if _vector_db is None:
+        return True
+    return calibrate_baselines(_vector_db, _library)
 
-    results_with_score = VECTOR_DB.similarity_search_with_score(query, k=k)
-    cleaned = []
 
-    for doc, score in results_with_score:
-        if score <= baseline_score:
+def _merge_shards(library: dict):
+    """
+    Load every document's shard and merge them into one searchable index.
+    """
+    merged = None
+    for doc_id, entry in library["documents"].items():
+        try:
+            shard, meta = load_index(_document_path(entry))
+        except Exception as e:
+            print(f"Error loading document {entry['title']}: {str(e)}")
             continue
+        entry["key"] = meta.get("key", index_key(_document_path(entry)))
+        entry["chunks"] = len(shard.index_to_docstore_id)
+        if merged is None:
+            merged = shard
+        else:
+            merged.merge_from(shard)
+    return merged
 
-        text = doc.page_content.strip()
-        page = doc.metadata.get("page", "unknown")
 
-        if not text or len(text.split()) < min_words:
-            continue
+def get_vector_db():
+    """
+    The library index, loaded on first use rather than at import time.
+    None when the library is empty.
+    """
+    global _library, _vector_db, _keyword_index, _chunks
+    if _library is not None:
+        return _vector_db
 
-        # Clean the text using GPT
-        cleaning_prompt = f"""
-Here is a noisy or partial paragraph from a negotiation manual:
+    # Shards are loaded or built without _vector_db_lock; only the swap takes it
+    with _load_lock:
+        if _library is None:
+            library = _load_library()
+            vector_db = _merge_shards(library)
+            chunks, keyword_index = _index_keywords(vector_db)
+            with _vector_db_lock:
+                _vector_db, _chunks, _keyword_index = vector_db, chunks, keyword_index
+                _library = library
+                if _calibrate_library():
+                    _save_library()
+    return _vector_db
 
-{text}
 
-Your job is to:
-- Remove partial sentences at the beginning or end
-- Make the paragraph grammatically clean and self-contained
-- Keep it brief (3–5 sentences), no added commentary
+def add_document(path: str, title: str = None) -> dict:
+    """
+    Index the PDF or transcript at `path` and append it to the library index.
+    """
+    doc_id = document_id(path)
+    get_vector_db()
+    with _vector_db_lock:
+        if doc_id in _library["documents"]:
+            return {"document_id": doc_id, **_library["documents"][doc_id]}
 
-Return only the cleaned paragraph.
-"""
+    # Embedding happens outside the lock so retrieval keeps working meanwhile
+    shard, meta = load_index(path)
+
+    global _vector_db, _chunks, _keyword_index
+    with _vector_db_lock:
+        # A concurrent upload of the same file may have added it meanwhile;
+        # merging the same shard twice would leave duplicate vectors behind
+        if doc_id in _library["documents"]:
+            return {"document_id": doc_id, **_library["documents"][doc_id]}
+        entry = {
+            "title": title or os.path.splitext(os.path.basename(path))[0],
+            "path": _relative_path(path),
+            "key": meta.get("key", index_key(path)),
+            "chunks": len(shard.index_to_docstore_id),
+        }
+        if _vector_db is None:
+            _vector_db = shard
+        else:
+            _vector_db.merge_from(shard)
+        _chunks, _keyword_index = _index_keywords(_vector_db)
+        _library["documents"][doc_id] = entry
+        _calibrate_library()
+        _save_library()
+    print(f"Added document {entry['title']} ({entry['chunks']} chunks)")
+    return {"document_id": doc_id, **entry}
+
+
+def remove_document(doc_id: str) -> bool:
+    """
+    Drop a document from the library and rebuild the index from the remaining shards.
+    """
+    global _vector_db, _chunks, _keyword_index
+    get_vector_db()
+    with _vector_db_lock:
+        entry = _library["documents"].pop(doc_id, None)
+        if entry is None:
+            return False
+        _vector_db = _merge_shards(_library)
+        _chunks, _keyword_index = _index_keywords(_vector_db)
+        _calibrate_library()
+        _save_library()
 
+    # Uploaded copies and the shard itself are no longer needed
+    path = _document_path(entry)
+    if os.path.commonpath([os.path.abspath(path), DOCUMENTS_DIR]) == DOCUMENTS_DIR:
         try:
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": cleaning_prompt}],
-                temperature=0,
-            )
-            cleaned_text = response.choices[0].message.content.strip()
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    if entry.get("key"):
+        shutil.rmtree(os.path.join(INDEX_STORE_DIR, entry["key"]), ignore_errors=True)
+    print(f"Removed document {entry['title']}")
+    return True
 
-        except Exception as e:
-            cleaned_text = text  # fallback to raw
 
-        cleaned.append({"text": cleaned_text, "page": page})
+def list_documents() -> list[dict]:
+    get_vector_db()
+    with _vector_db_lock:
+        return [
+            {"document_id": doc_id, "title": entry["title"], "chunks": entry.get("chunks")}
+            for doc_id, entry in _library["documents"].items()
+        ]
+
+
+def get_baseline_score(name: str = "default") -> float:
+    """
+    Distance of the closest chunk to the baseline query `name`, computed once per library.
+    """
+    get_vector_db()
+    return _library["baselines"][name]["score"]
+
+
+def _index_keywords(vector_db):
+    """
+    The chunks of the merged vector index, in FAISS order, and a BM25 index over them.
+    """
+    if vector_db is None:
+        return [], None
+    chunks = [
+        vector_db.docstore.search(docstore_id)
+        for _, docstore_id in sorted(vector_db.index_to_docstore_id.items())
+    ]
+    return chunks, BM25([_chunk_text(doc) for doc in chunks])
+
+
+def _chunk_text(doc) -> str:
+    # Cleaned once when the index was built
+    return doc.metadata.get("cleaned") or doc.page_content.strip()
+
+
+def retrieve_chunks(
+    query: str, k: int = 3, min_words: int = 30, baseline: str = "default"
+) -> list[dict]:
+    """
+    Hybrid retrieval: FAISS and BM25 candidates fused by reciprocal rank.
+    Vector hits must be more relevant to the query than to a generic phrase;
+    `baseline` names the reference query in BASELINE_QUERIES to compare against.
+    Returns cleaned text, page and the title of the document it comes from.
+    """
+    # Turns during the first load of the library go without book content
+    # instead of each holding a worker thread until it is ready
+    if _library is None and _load_lock.locked():
+        return []
+    if get_vector_db() is None:
+        return []
+
+    # Embedding may be a network call, so it happens before taking the lock
+    query_vector = get_embeddings().embed_query(query)
+
+    with _vector_db_lock:
+        vector_db = _vector_db
+        if vector_db is None:
+            return []
+        baseline_score = get_baseline_score(baseline)
+        titles = {
+            doc_id: entry["title"] for doc_id, entry in _library["documents"].items()
+        }
+        chunks, keyword_index = _chunks, _keyword_index
+        # merge_from changes the FAISS index in place, so search under the lock
+        vector_hits = vector_db.similarity_search_with_score_by_vector(
+            query_vector, k=RETRIEVAL_CANDIDATES
+        )
+
+    # The BM25 index is replaced, never modified, so it is searched outside
+    keyword_hits = keyword_index.top(query, RETRIEVAL_CANDIDATES)
+
+    vector_hits = [doc for doc, score in vector_hits if score > baseline_score]
+    keyword_hits = [chunks[index] for index, _ in keyword_hits]
+
+    # Reciprocal rank fusion of the two candidate lists
+    fused = {}
+    for ranked in (vector_hits, keyword_hits):
+        for rank, doc in enumerate(ranked):
+            key = (doc.metadata.get("document_id"), doc.page_content)
+            score, _ = fused.get(key, (0.0, doc))
+            fused[key] = (score + 1.0 / (RRF_K + rank + 1), doc)
+
+    results = []
+    for fusion_score, doc in sorted(fused.values(), key=lambda item: item[0], reverse=True):
+        text = _chunk_text(doc)
+        if not text or len(doc.page_content.split()) < min_words:
+            continue
+
+        doc_id = doc.metadata.get("document_id")
+        results.append(
+            {
+                "text": text,
+                "page": doc.metadata.get("page", "unknown"),
+                "document_id": doc_id,
+                "title": titles.get(doc_id, BOOK_TITLE),
+                "score": fusion_score,
+            }
+        )
+        if len(results) == k:
+            break
+    return results
+
+
+def _cosine(a, b) -> float:
+    a, b = np.asarray(a, dtype=np.float32), np.asarray(b, dtype=np.float32)
+    norm = float(np.linalg.norm(a) * np.linalg.norm(b))
+    return float(a @ b) / norm if norm else 0.0
+
+
+def rerank_chunks(
+    chunks: list[dict], kirk_reply: str, user_query: str
+) -> Optional[dict]:
+    """
+    Pick the retrieved chunk that best supports Kirk's reply, or None if none does.
+    A chunk must share at least RERANK_MIN_SHARED_TERMS content words with the
+    reply; eligible chunks are ranked by embedding similarity to the reply and
+    the query plus their word overlap with the reply.
+    """
+    reply_terms = set(tokenize(kirk_reply))
+    candidates = [
+        (chunk, len(reply_terms & set(tokenize(chunk["text"]))))
+        for chunk in chunks
+    ]
+    candidates = [
+        (chunk, shared)
+        for chunk, shared in candidates
+        if shared >= RERANK_MIN_SHARED_TERMS
+    ]
+    if not candidates:
+        return None
+
+    embeddings = get_embeddings()
+    reply_vector = embeddings.embed_query(kirk_reply)
+    query_vector = embeddings.embed_query(user_query)
+    chunk_vectors = embeddings.embed_documents([chunk["text"] for chunk, _ in candidates])
+
+    best, best_score = None, None
+    for (chunk, shared), vector in zip(candidates, chunk_vectors):
+        score = (
+            _cosine(reply_vector, vector)
+            + 0.5 * _cosine(query_vector, vector)
+            + shared / len(reply_terms)
+        )
+        # Strictly greater keeps the earlier (better retrieved) chunk on ties
+        if best_score is None or score > best_score:
+            best, best_score = chunk, score
+    return best
 
-    return cleaned
+if __name__ == "__main__":
+    # Build step: python -m whisper.rag_engine
+    get_vector_db()
+    for document in list_documents():
+        print(f"{document['document_id']}  {document['title']}: {document['chunks']} chunks")
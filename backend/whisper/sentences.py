@@ -0,0 +1,40 @@
+# sentences.py
+
+import re
+from typing import Optional
+
+# End of a sentence: terminal punctuation, optional closing quotes/brackets,
+# then whitespace (which only arrives with the next token)
+SENTENCE_END = re.compile(r"[.!?…]+[\"'”’)\]]*\s+")
+
+
+class SentenceSplitter:
+    """
+    Incrementally split streamed text into complete sentences.
+    Fragments shorter than `min_chars` are merged into the next sentence so
+    each TTS request carries enough text to sound natural.
+    """
+
+    def __init__(self, min_chars: int = 20):
+        self.min_chars = min_chars
+        self.buffer = ""
+
+    def feed(self, text: str) -> list[str]:
+        """Add streamed text and return any sentences it completed."""
+        self.buffer += text
+        sentences = []
+        start = 0
+        for match in SENTENCE_END.finditer(self.buffer):
+            candidate = self.buffer[start:match.end()].strip()
+            if len(candidate) < self.min_chars:
+                continue
+            sentences.append(candidate)
+            start = match.end()
+        self.buffer = self.buffer[start:]
+        return sentences
+
+    def flush(self) -> Optional[str]:
+        """Return whatever is left once the stream has ended."""
+        rest = self.buffer.strip()
+        self.buffer = ""
+        return rest or None
@@ -4,6 +4,16 @@ import './ChatInterface.css';
 
 const BACKEND_URL = 'http://localhost:8000';
 
+// Each browser keeps its own conversation with Kirk on the server
+const getSessionId = () => {
+  let sessionId = localStorage.getItem('kirkSessionId');
+  if (!sessionId) {
+    sessionId = crypto.randomUUID().replace(/-/g, '');
+    localStorage.setItem('kirkSessionId', sessionId);
+  }
+  return sessionId;
+};
+
 const ChatInterface: React.FC = () => {
   const [text, setText] = useState('');
   const [audioURL, setAudioURL] = useState<string | null>(null);
@@ -12,9 +22,135 @@ const ChatInterface: React.FC = () => {
   const [summary, setSummary] = useState<string | null>(null);
   const [bookInsight, setBookInsight] = useState<string | null>(null);
   const [isLoading, setIsLoading] = useState(false);
+  const [error, setError] = useState<string | null>(null);
   const [useVideo, setUseVideo] = useState(true);
 
   const audioRef = useRef<HTMLAudioElement | null>(null);
+  const audioQueueRef = useRef<string[]>([]);
+  const isPlayingRef = useRef(false);
+
+  // Sentence clips from the streaming endpoint are played back to back
+  const enqueueAudio = (url: string) => {
+    if (isPlayingRef.current) {
+      audioQueueRef.current.push(url);
+    } else {
+      isPlayingRef.current = true;
+      setAudioURL(url);
+    }
+  };
+
+  const playNextAudio = () => {
+    const next = audioQueueRef.current.shift();
+    if (next) {
+      setAudioURL(next);
+    } else {
+      isPlayingRef.current = false;
+    }
+  };
+
+  const fetchInsight = (insightURL: string) => {
+    // Summary and book insight are generated after the audio/video
+    fetch(`${BACKEND_URL}${insightURL}`)
+      .then((res) => (res.ok ? res.json() : null))
+      .then((insight) => {
+        if (insight) {
+          setSummary(insight.summary);
+          setBookInsight(insight.book_insight);
+        }
+      })
+      .catch((err) => console.error('Error fetching insight:', err));
+  };
+
+  const handleStreamEvent = (event: any) => {
+    if (event.type === 'token') {
+      setKirkResponse((previous) => (previous ?? '') + event.text);
+    } else if (event.type === 'audio') {
+      enqueueAudio(`${BACKEND_URL}${event.audio_url}`);
+    } else if (event.type === 'done') {
+      setKirkResponse(event.text);
+      if (event.summary) {
+        setSummary(event.summary);
+        setBookInsight(event.book_insight);
+      } else if (event.insight_url) {
+        fetchInsight(event.insight_url);
+      }
+    } else if (event.type === 'error') {
+      console.error('Streaming error:', event.detail);
+      setError(event.detail || 'Kirk could not answer this time.');
+    }
+  };
+
+  // Returns false when the backend cannot stream (e.g. simplified_main.py)
+  const streamResponse = async () => {
+    const response = await fetch(`${BACKEND_URL}/chat/stream`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        'X-Session-Id': getSessionId(),
+      },
+      body: JSON.stringify({ text }),
+    });
+    if (!response.ok || !response.body) return false;
+
+    // Read server-sent events from the response body as they arrive
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      const messages = buffer.split('\n\n');
+      buffer = messages.pop() ?? '';
+      for (const message of messages) {
+        if (message.startsWith('data: ')) {
+          handleStreamEvent(JSON.parse(message.slice(6)));
+        }
+      }
+    }
+    return true;
+  };
+
+  // One-shot reply with audio (and video when asked for) URLs
+  const requestResponse = async (endpoint: string, body: object) => {
+    console.log(`Sending request to ${endpoint}`);
+    const response = await fetch(`${BACKEND_URL}${endpoint}`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        'X-Session-Id': getSessionId(),
+      },
+      body: JSON.stringify(body),
+    });
+
+    if (!response.ok) {
+      const detail = await response.json().then((data) => data.detail).catch(() => null);
+      throw new Error(detail || `Request failed (${response.status})`);
+    }
+
+    const data = await response.json();
+    console.log('Response data:', data);
+    
+    setKirkResponse(data.text);
+    setSummary(data.summary ?? null);
+    setBookInsight(data.book_insight ?? null);
+
+    if (data.insight_url) {
+      fetchInsight(data.insight_url);
+    }
+    
+    if (data.audio_url) {
+      setAudioURL(`${BACKEND_URL}${data.audio_url}`);
+    }
+    
+    if (data.video_url) {
+      setVideoURL(`${BACKEND_URL}${data.video_url}`);
+    }
+    if (data.error) {
+      setError(data.error);
+    }
+  };
 
   const handleTranscription = (transcribedText: string) => {
     setText(transcribedText);
@@ -27,38 +163,26 @@ const ChatInterface: React.FC = () => {
     setIsLoading(true);
     setAudioURL(null);
     setVideoURL(null);
+    audioQueueRef.current = [];
+    isPlayingRef.current = false;
+    setError(null);
 
     try {
-      // Choose endpoint based on video toggle
-      const endpoint = useVideo ? '/generate-video' : '/generate-speech';
-      
-      console.log(`Sending request to ${endpoint}`);
-      const response = await fetch(`${BACKEND_URL}${endpoint}`, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({ text }),
-      });
-
-      if (response.ok) {
-        const data = await response.json();
-        console.log('Response data:', data);
-        
-        setKirkResponse(data.text);
-        setSummary(data.summary);
-        setBookInsight(data.book_insight);
-        
-        if (data.audio_url) {
-          setAudioURL(`${BACKEND_URL}${data.audio_url}`);
-        }
-        
-        if (data.video_url) {
-          setVideoURL(`${BACKEND_URL}${data.video_url}`);
+      if (!useVideo) {
+        // Audio-only replies stream text and per-sentence audio
+        setKirkResponse('');
+        setSummary(null);
+        setBookInsight(null);
+        if (!(await streamResponse())) {
+          await requestResponse('/generate-speech', { text });
         }
+        return;
       }
-    } catch (error) {
-      console.error('Error generating response:', error);
+
+      await requestResponse('/generate-video', { text, stream: true });
+    } catch (err) {
+      console.error('Error generating response:', err);
+      setError(err instanceof Error ? err.message : 'Kirk could not answer this time.');
     } finally {
       setIsLoading(false);
     }
@@ -108,6 +232,12 @@ const ChatInterface: React.FC = () => {
 
       <div className="chat-main">
         <div className="chat-left">
+          {error && (
+            <div className="chat-error">
+              <p>{error}</p>
+            </div>
+          )}
+
           {kirkResponse && (
             <div className="kirk-response">
               <p>{kirkResponse}</p>
@@ -130,6 +260,8 @@ const ChatInterface: React.FC = () => {
               <audio
                 ref={audioRef}
                 src={audioURL}
+                onEnded={playNextAudio}
+                onError={playNextAudio}
                 controls
                 className="audio-player"
               />